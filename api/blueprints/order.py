@@ -1,16 +1,27 @@
 from flask import Blueprint, jsonify, request, current_app
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
 import stripe
 import os
 import json
+import time
 
 from ...database import db
 from ..decorators import token_required
-from ..models import Address, Cart_Item, Order
+from ..models import Address, Cart_Item, Order, Portion
 from ..models.order import Order_Status, Pay_Status, Deliver_Method
+from ..utils.cache_invalidation import mark_products_changed
+from ..utils.stock_holds import place_stock_hold, release_stock_hold
 
 webhook_secret = os.getenv('WEBHOOK_SECRET')
 
+# loads what Order.as_dict serializes for a page of orders in batches, instead of one query per order
+order_items_loaders = [
+    selectinload(Order.cart_items).selectinload(Cart_Item.product),
+    selectinload(Order.cart_items).selectinload(Cart_Item.portion),
+    selectinload(Order.address),
+]
+
 order_bp = Blueprint('order', __name__)
 
 @order_bp.route('/', methods = ['GET'])
@@ -32,7 +43,7 @@ def order_history_index () :
         # check if recent query parameter is included and set to true
         is_recent = request.args.get('recent', '').lower() == 'true'
 
-        base_query =  Order.query.filter_by(user_id = user.id).order_by(Order.date.desc())
+        base_query =  Order.query.filter_by(user_id = user.id).order_by(Order.date.desc()).options(*order_items_loaders)
         
         if is_recent :
             # filter by user, sort by date, only take most recent 3
@@ -174,8 +185,8 @@ def get_fulfillment_orders_by_status (admin, status, page, delivery_method, sear
                 # add delivery method filter if present
                 base_query = base_query.filter_by(delivery_method = Deliver_Method[delivery_method.upper()])
 
-            # join task with order
-            base_query = base_query.options(joinedload(Order.task))
+            # join task with order, and load the items and addresses in batches
+            base_query = base_query.options(joinedload(Order.task), *order_items_loaders)
 
             # makes query, orders by date, paginates
             orders = (
@@ -343,6 +354,9 @@ def create_checkout_session() :
     '''
     Creates a Stripe checkout session for the authenticated user based on cart information.
 
+    The cart's stock is held for as long as the checkout can be paid, so it cannot be sold to
+    another customer in the meantime. The hold is released when the order is created or the checkout expires.
+
     Request Body :
         cart (Cart_Item) : cart_items the user is checking out for.
         method (str) : delivery method for the order.
@@ -351,6 +365,7 @@ def create_checkout_session() :
     
     Returns :
         Response : JSON response with the Stripe checkout URL or error message.
+        On insufficient available stock, a 409 error response listing the portions that are short.
     '''
     user = request.user
     
@@ -384,18 +399,43 @@ def create_checkout_session() :
         line_items.append(line_item)
         cart_ids.append(item['id'])
 
+    hold_id = None
+
     try :
-        # create stripe checkout session
+        # hold the stock of every line, several lines can share a portion
+        quantities = {}
+        for item in cart :
+            portion_id = int(item['portion']['id'])
+            quantities[portion_id] = quantities.get(portion_id, 0) + int(item['quantity'])
+
+        stock = dict(db.session.execute(
+            select(Portion.id, Portion.stock).where(Portion.id.in_(quantities))
+        ).all())
+
+        checkout_ttl = current_app.config['CHECKOUT_SESSION_TTL']
+
+        # the hold replaces the one left by the user's previous checkout, if any
+        hold_id, short = place_stock_hold(quantities, stock, checkout_ttl + current_app.config['STOCK_HOLD_GRACE_PERIOD'], user.id)
+
+        if short :
+            return jsonify({
+                'error': 'Insufficient stock',
+                'portions': short
+            }), 409
+
+        # create stripe checkout session, expiring before the hold does
         session = stripe.checkout.Session.create(
             line_items = line_items,
             mode = 'payment',
             success_url = 'http://localhost:3000/cart/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url = 'http://localhost:3000/cart',
+            expires_at = int(time.time()) + checkout_ttl,
             metadata = {
                 'cart': str(cart_ids), # pass in string of cart ids for order creation
                 'method': method, # pass in delivery method from delivery form input
                 'user': user.id, # pass in user id for order creation
-                'address_id': address_id # only passing in shipping address to associate with order
+                'address_id': address_id, # only passing in shipping address to associate with order
+                'hold_id': hold_id # stock hold to release once the order is created or the checkout expires
             }
         )
 
@@ -404,6 +444,9 @@ def create_checkout_session() :
         })
     
     except Exception as error :
+        if hold_id :
+            release_stock_hold(hold_id)
+
         current_app.logger.error(f'Error: {str(error)}')
         return jsonify({
             'error': 'Internal server error'
@@ -447,10 +490,20 @@ def handle_stripe_webhook () :
             method = session['metadata'].get('method')
             user_id = session['metadata'].get('user')
             address_id = session['metadata'].get('address_id')
+            hold_id = session['metadata'].get('hold_id')
 
             # create instance of order
             new_order = create_order(address_id, user_id, method)
 
+            # the held stock was decremented with the order, or is definitely short, either way the hold is done.
+            # any other failure keeps the hold, so the stock is still there when Stripe retries the webhook
+            if hold_id and (isinstance(new_order, Order) or new_order[1] == 409) :
+                release_stock_hold(hold_id)
+
+            # order could not be created, e.g. some lines are out of stock
+            if not isinstance(new_order, Order) :
+                return new_order
+
             try :
                 # finalize order with session and payment info from stripe
                 new_order.finalize_order_payment(session['id'], session['payment_intent'])
@@ -462,6 +515,13 @@ def handle_stripe_webhook () :
                     'error': 'Internal server error'
                 }), 500
 
+        elif event and event['type'] == 'checkout.session.expired' :
+            # checkout abandoned, return its held stock without waiting for the sweeper
+            hold_id = event['data']['object']['metadata'].get('hold_id')
+
+            if hold_id :
+                release_stock_hold(hold_id)
+
         else :
             print('Unhandled event type {}'.format(event['type']))
     
@@ -478,14 +538,43 @@ def create_order (address, user, method) :
         user (int) : ID of the user placing the order.
         method (str) : delivery method for the order.
     
+    Stock for every line is reserved with one conditional update before the order is written, in the same
+    transaction, so an order is never committed for stock that is no longer there.
+
     Returns :
         Order instance if successful, otherwise an error response.
+        On insufficient stock, a 409 error response listing the cart items that could not be fulfilled.
     '''
     try :
         # find the cart items and calculate total
-        items_to_associate = Cart_Item.query.filter_by(user_id = user, ordered = False).all()
+        items_to_associate = Cart_Item.query.filter_by(user_id = user, ordered = False).options(joinedload(Cart_Item.product)).all()
         total = sum(item.price for item in items_to_associate)
 
+        # several lines can share a portion, reserve their combined quantity
+        quantities = {}
+        for item in items_to_associate :
+            quantities[item.portion_id] = quantities.get(item.portion_id, 0) + item.quantity
+
+        reserved, unfulfilled = Portion.reserve_stock(quantities)
+
+        if unfulfilled :
+            db.session.rollback()
+
+            unfulfilled_items = [ item.id for item in items_to_associate if item.portion_id in unfulfilled ]
+            current_app.logger.error(f'Insufficient stock for cart items {unfulfilled_items} of user {user}')
+
+            return jsonify({
+                'error': 'Insufficient stock',
+                'cartItems': unfulfilled_items
+            }), 409
+
+        # stock changes can move products between listing pages
+        mark_products_changed(
+            db.session,
+            { item.product_id for item in items_to_associate },
+            { item.product.category.value for item in items_to_associate },
+        )
+
         # create instance of order and associate with user
         new_order = Order(
             user_id = user,
@@ -498,14 +587,10 @@ def create_order (address, user, method) :
 
         db.session.add(new_order)
 
-        # commit and refresh to get access to new_order.id
-        db.session.commit()
-        db.session.refresh(new_order)
+        # flush to get access to new_order.id, committing together with the stock reservation
+        db.session.flush()
 
         new_order.associate_items(items_to_associate)
-
-        for item in items_to_associate :
-            item.portion.update_stock(item.portion.stock - item.quantity)
         
         db.session.commit()
 
@@ -514,6 +599,7 @@ def create_order (address, user, method) :
         return new_order
         
     except Exception as error :
+        db.session.rollback()
         current_app.logger.error(f'Error creating order: {str(error)}')
         return jsonify({
             'error': 'Internal server error'
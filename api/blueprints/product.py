@@ -1,54 +1,93 @@
 from flask import Blueprint, jsonify, request, current_app
-from sqlalchemy import text, func
-from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy import func, and_, or_, select, cast, literal_column, String, Float, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import selectinload, load_only
+from decimal import Decimal
+from datetime import datetime, timezone
+import base64
+import hashlib
+import json
+import math
 
 
 from ...database import db
-from ..decorators import token_required
-from ..utils.redis_service import need_product_cache_bucket, cache_products, get_product_cache, get_filtered_products_cache, cache_filtered_products
-from ..models import Product, Category, Portion, Role, Portion_Size
-
-from ..utils.aws_s3 import s3_photo_upload
+from ..decorators import token_required, etag_cached
+from ..utils.redis_service import ensure_catalog_cache, get_product_cache_raw, filtered_products_cache_key, get_filtered_products_cache, cache_filtered_products, cache_product_entries, get_product_revisions, get_catalog_revision, get_product_revision, get_indexed_page, get_products_cache
+from ..models import Product, Category, Portion, Role
+from ..models.portion import restock_margin
+from ..models.inventory import stock_at
+
+from ..utils.local_cache import page_cache
+from ..utils.cache_invalidation import mark_products_changed
+from ..utils.json_provider import raw_json_response
+from ..utils.aws_s3 import validate_image_file, read_image_file, presign_image_upload, upload_key_prefix, s3_object_exists
+from ..utils.image_pipeline import enqueue_product_image, enqueue_uploaded_product_image
 
 product_bp = Blueprint('product', __name__)
 
 
+def product_index_etag () :
+    '''
+    Derives the ETag of a product listing from the catalog revision and the query parameters.
+    '''
+    query = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items(multi = True)))
+    return hashlib.sha1(f'{get_catalog_revision()}?{query}'.encode()).hexdigest()
+
+
 @product_bp.route('/', methods = ['GET'])
+@etag_cached(product_index_etag)
 def product_index () :
     '''
     Retrieves a paginated list of products with optional filters for category, 
     search term, and sorting. Products with no portions in stock are pushed to the 
     bottom of the list.
 
+    Supports two pagination modes, page numbers (default) and keyset pagination, which is
+    enabled by passing the cursor parameter (empty for the first page). Keyset pagination
+    skips the offset scan and the total count, so every page costs the same as the first.
+
     Query Parameters :
     - page (int) : The page number for pagination (default is 1).
+    - cursor (str) : opaque token from a previous response's nextCursor.
     - category (str) : category to filter products by.
-    - search (str) : search term to filter products by name.
+    - search (str) : search term to filter products by name, results are ranked by relevance unless sorted.
     - sort (str) : sorting option ('priceAsc', 'priceDesc', 'nameAsc', 'nameDesc').
+    - fields (str) : comma separated product fields to return, or 'card' for the compact grid projection.
 
     Returns :
-    - JSON response containing the list of product dictionaries, total pages, and current page.
+    - JSON response containing the list of product dictionaries, total pages, and current page,
+      or the list of product dictionaries and nextCursor in keyset mode.
+    - If If-None-Match matches the catalog revision for these parameters, returns a 304 status without a body.
+    - On invalid page, invalid cursor or unknown fields, returns a 400 status with an error message.
     - On error, returns a 500 status with an error message.
     '''
     try :
-        if need_product_cache_bucket() :
-            products = Product.query.all()
-            cache_products(products)
+        # load portions in one query rather than one per product during serialization
+        ensure_catalog_cache(lambda : Product.query.options(selectinload(Product.portions)).all())
 
         # extract page and params
         page = request.args.get('page', 1, type = int)
+        cursor = request.args.get('cursor')
         category = request.args.get('category')
         search = request.args.get('search')
         sort = request.args.get('sort')
 
-        cache_key = f'filter:products:{page}:{category}:{search}:{sort}'
+        # collapse whitespace so equivalent searches match the same products and share a cache entry
+        search = ' '.join(search.split()) if search else None
 
-        cached_products = get_filtered_products_cache(cache_key)
+        # pages start at 1, anything lower would read the end of the listing indexes
+        if page < 1 :
+            return jsonify({
+                'error': 'Invalid page'
+            }), 400
 
-        if cached_products :
-            return jsonify(
-                cached_products
-            ), 200
+        try :
+            fields = parse_product_fields(request.args.get('fields'))
+        except ValueError as error :
+            return jsonify({
+                'error': str(error)
+            }), 400
 
         # base query to build upon based on params 
         base_query = Product.query
@@ -57,71 +96,96 @@ def product_index () :
             # adding cateogry filter to query, use uppercase for enum
             base_query = base_query.filter_by(category = Category[category.upper()])
 
-        if sort and sort != 'recommended':
-            # to map sort options, utilizing text() in query
-            sort_options = {
-                'priceAsc': 
-                    '''
-                        COALESCE(
-                            (SELECT price FROM portions
-                            WHERE portions.product_id = products.id
-                            AND portions.size = :whole
-                            LIMIT 1), 0
-                        ) ASC
-                    '''
-                ,
-                'priceDesc':
-                    '''
-                        COALESCE(
-                            (SELECT price FROM portions
-                            WHERE portions.product_id = products.id
-                            AND portions.size = :whole
-                            LIMIT 1), 0
-                        ) DESC
-                    '''
-                ,
-                'nameAsc': 'name ASC',
-                'nameDesc': 'name DESC',
+        if search :
+            # escape wildcards so the search is a plain substring match, served by the trigram index on name
+            escaped_search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            base_query = base_query.filter(Product.name.ilike(f'%{escaped_search}%', escape = '\\'))
+
+        sort_keys = listing_sort_keys(sort, search)
+
+        if cursor is not None :
+            return product_index_by_cursor(base_query, sort, sort_keys, cursor, fields)
+
+        cache_key = filtered_products_cache_key(page, category, search, sort)
+
+        # pages already assembled by this worker, kept per projection
+        local_key = f"{cache_key}:{','.join(fields)}" if fields else cache_key
+        cached_page = page_cache.get(local_key)
+
+        if cached_page :
+            return jsonify(cached_page), 200
+
+        # listings without a search are served from the catalog's sorted set indexes, without the database
+        indexed_page = get_indexed_page(category.upper() if category else 'ALL', sort, page, per_page = 10) if not search else None
+
+        if indexed_page is not None :
+            product_ids, total = indexed_page
+
+            if not product_ids :
+                return jsonify({
+                    'products': [],
+                    'message': 'No products found'
+                }), 200
+
+            cached, missing_ids = get_products_cache(product_ids)
+            response = {
+                'products': project_products(hydrate_products(product_ids, cached, missing_ids), fields),
+                'totalPages': math.ceil(total / 10),
+                'currentPage': page
             }
-        
-            sort_option = sort_options.get(sort)
 
-            if sort_option and sort in ['priceAsc', 'priceDesc'] :
-                # adding sort to query
-                base_query = base_query.order_by(text(sort_option).params(whole = Portion_Size.WHOLE.value))
-            elif sort_option :
-                base_query = base_query.order_by(text(sort_option))
+            page_cache.set(local_key, response)
 
-        if search :
-            base_query = base_query.filter(Product.name.ilike(f'%{search}%'))
+            return jsonify(response), 200
 
-        # sub query to push products with no portions in stock down to the bottom
-        sub_query = db.session.query(
-            func.sum(Portion.stock).label('total_stock')
-            ).filter(Portion.product_id == Product.id
-            ).group_by(Portion.product_id).scalar_subquery()
-        
-        base_query = base_query.order_by(func.coalesce(sub_query, 0).desc())
+        cached_products = get_filtered_products_cache(cache_key)
+
+        if cached_products is not None and not cached_products['ids'] :
+            return jsonify({
+                'products': [],
+                'message': 'No products found'
+            }), 200
+
+        if cached_products :
+            products_list = hydrate_products(cached_products['ids'], cached_products['products'], cached_products['missingIds'])
+            response = {
+                'products': project_products(products_list, fields),
+                'totalPages': cached_products['totalPages'],
+                'currentPage': cached_products['currentPage']
+            }
+
+            page_cache.set(local_key, response)
+
+            return jsonify(response), 200
 
-        # applying query with pagination
-        products = base_query.paginate(page = page, per_page = 10)
+        if current_app.config['LISTING_ENGINE'] == 'json_agg' :
+            return product_index_json(base_query, sort_keys, page, cache_key, category, fields)
+
+        # applying sort, projection and query with pagination
+        products = (with_product_fields(base_query, fields)
+            .order_by(*[ expression.desc() if descending else expression.asc() for name, expression, descending in sort_keys ])
+            .paginate(page = page, per_page = 10)
+        )
 
         # if products are returned...
         if products.items :
             
-            products_list = [ product.as_dict() for product in products.items ]
+            products_list = [ product.as_dict() if fields is None else product.as_projection(fields) for product in products.items ]
             response = {
                 'products': products_list,
                 'totalPages': products.pages,
                 'currentPage': page
             }
 
-            cache_filtered_products(cache_key, response)
+            cache_filtered_products(cache_key, [ product.id for product in products.items ], products.pages, page, category)
+            page_cache.set(local_key, response)
             
             return jsonify(response), 200
         
-        # otherwise, return empty array
+        # otherwise, cache the miss briefly and return empty array
         else :
+            cache_filtered_products(cache_key, [], 0, page, category)
+
             return jsonify({
                 'products': [],
                 'message': 'No products found'
@@ -134,19 +198,342 @@ def product_index () :
         }), 500
 
 
+def product_index_json (base_query, sort_keys, page, cache_key, category, fields = None) :
+    '''
+    Retrieves one page of the product listing with the response body assembled by Postgres.
+
+    Products, their portions and the total count are built into JSON with json_build_object and json_agg
+    in a single statement, and the resulting text is sent as the response body without loading ORM objects
+    or serializing in Python.
+
+    Args :
+        base_query (Query) : product query with category and search filters applied.
+        sort_keys (list) : sort keys of the listing, see listing_sort_keys.
+        page (int) : page number.
+        cache_key (str) : filtered page cache key the page ids are cached under.
+        category (str) : category filter of the page, or None.
+        fields (list) : product fields to build, or None for the full product.
+
+    Returns :
+        Response : JSON response containing the list of product dictionaries, total pages, and current page.
+    '''
+    per_page = 10
+    order = [ expression.desc() if descending else expression.asc() for name, expression, descending in sort_keys ]
+
+    portions_json = (select(func.coalesce(func.json_agg(aggregate_order_by(portion_json_object(), Portion.id)), literal_column("'[]'::json")))
+        .where(Portion.product_id == Product.id)
+        .scalar_subquery()
+    )
+
+    field_expressions = {
+        'id': Product.id,
+        'name': Product.name,
+        'description': Product.description,
+        'category': func.lower(cast(Product.category, String)),
+        'image': Product.image,
+        'price': cast(Product.whole_price, Float),
+        'soldOut': Product.total_stock == 0,
+        'portions': portions_json,
+    }
+
+    fields = fields or ['id', 'name', 'description', 'category', 'image', 'portions']
+    product_json = func.json_build_object(*[ item for field in fields for item in (field, field_expressions[field]) ])
+
+    # window functions run before the limit, so every row carries its position and the unpaginated total
+    page_rows = (base_query
+        .with_entities(
+            Product.id.label('id'),
+            product_json.label('product'),
+            func.row_number().over(order_by = order).label('position'),
+            func.count().over().label('total'),
+        )
+        .order_by(*order)
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+        .subquery()
+    )
+
+    payload, product_ids, total = db.session.execute(
+        select(
+            cast(func.json_agg(aggregate_order_by(page_rows.c.product, page_rows.c.position)), Text),
+            func.array_agg(aggregate_order_by(page_rows.c.id, page_rows.c.position)),
+            func.max(page_rows.c.total),
+        )
+    ).one()
+
+    if not product_ids :
+        cache_filtered_products(cache_key, [], 0, page, category)
+
+        return jsonify({
+            'products': [],
+            'message': 'No products found'
+        }), 200
+
+    total_pages = math.ceil(total / per_page)
+    cache_filtered_products(cache_key, product_ids, total_pages, page, category)
+
+    return current_app.response_class(
+        f'{{"products": {payload}, "totalPages": {total_pages}, "currentPage": {page}}}',
+        mimetype = 'application/json'
+    ), 200
+
+
+def portion_json_object () :
+    '''
+    Builds a portion as a JSON object in SQL, matching Portion.as_dict.
+    '''
+    return func.json_build_object(
+        'id', Portion.id,
+        'size', func.lower(cast(Portion.size, String)),
+        'optimalStock', Portion.optimal_stock,
+        'stock', Portion.stock,
+        'price', cast(Portion.price, Float),
+        'soldOut', Portion.stock == 0,
+    )
+
+
+def product_index_by_cursor (base_query, sort, sort_keys, cursor, fields = None) :
+    '''
+    Retrieves one page of the product listing after the given cursor using keyset pagination.
+
+    Args :
+        base_query (Query) : product query with category and search filters applied.
+        sort (str) : requested sorting option, encoded into the cursor.
+        sort_keys (list) : sort keys of the listing, see listing_sort_keys.
+        cursor (str) : cursor from a previous page, or empty string for the first page.
+        fields (list) : product fields to return, or None for the full product.
+
+    Returns :
+        Response : JSON response containing the list of product dictionaries and the nextCursor,
+        or a 400 status with an error message if the cursor is invalid.
+    '''
+    per_page = 10
+
+    query = with_product_fields(base_query, fields).add_columns(*[ expression.label(name) for name, expression, descending in sort_keys ])
+
+    if cursor :
+        try :
+            values = decode_listing_cursor(cursor, sort, sort_keys)
+        except ValueError :
+            return jsonify({
+                'error': 'Invalid cursor'
+            }), 400
+
+        query = query.filter(keyset_condition(sort_keys, values))
+
+    # fetch one extra row to know whether there is a next page without counting
+    rows = (query
+        .order_by(*[ expression.desc() if descending else expression.asc() for name, expression, descending in sort_keys ])
+        .limit(per_page + 1)
+        .all()
+    )
+
+    next_cursor = encode_listing_cursor(sort, sort_keys, rows[per_page - 1][1:]) if len(rows) > per_page else None
+    products_list = [ row[0].as_dict() if fields is None else row[0].as_projection(fields) for row in rows[:per_page] ]
+
+    if products_list :
+        return jsonify({
+            'products': products_list,
+            'nextCursor': next_cursor
+        }), 200
+
+    else :
+        return jsonify({
+            'products': [],
+            'nextCursor': None,
+            'message': 'No products found'
+        }), 200
+
+
+# fields the product listing can be narrowed to with the fields parameter, and the columns each one reads
+product_field_columns = {
+    'id': [Product.id],
+    'name': [Product.name],
+    'description': [Product.description],
+    'category': [Product.category],
+    'image': [Product.image],
+    'price': [Product.whole_price],
+    'soldOut': [Product.total_stock],
+    'portions': [],
+}
+
+# compact projection for the product cards of the catalog grid
+card_fields = ['id', 'name', 'image', 'category', 'price', 'soldOut']
+
+
+def parse_product_fields (fields) :
+    '''
+    Parses the fields query parameter of the product listing.
+
+    Args :
+        fields (str) : comma separated field names, 'card' for the card projection, or None.
+
+    Returns :
+        list : fields to return, always including id, or None for the full product.
+
+    Raises :
+        ValueError : if an unknown field is requested.
+    '''
+    if not fields :
+        return None
+
+    if fields == 'card' :
+        return card_fields
+
+    requested = [ field.strip() for field in fields.split(',') if field.strip() ]
+    unknown = [ field for field in requested if field not in product_field_columns ]
+
+    if unknown :
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    return ['id', *[ field for field in dict.fromkeys(requested) if field != 'id' ]]
+
+
+def with_product_fields (query, fields) :
+    '''
+    Restricts a product query to the columns backing the requested fields, deferring every other column,
+    and eagerly loads portions only when they are requested.
+    '''
+    if fields is None :
+        return query.options(selectinload(Product.portions))
+
+    query = query.options(load_only(*[ column for field in fields for column in product_field_columns[field] ]))
+
+    if 'portions' in fields :
+        query = query.options(selectinload(Product.portions))
+
+    return query
+
+
+def project_products (products, fields) :
+    '''
+    Narrows cached product dictionaries to the requested fields, deriving price and soldOut from the portions.
+
+    Args :
+        products (list) : full product dictionaries.
+        fields (list) : fields to keep, or None to keep the full products.
+
+    Returns :
+        list : projected product dictionaries.
+    '''
+    if fields is None :
+        return products
+
+    derived = {
+        'price': lambda product : next((portion['price'] for portion in product['portions'] if portion['size'] == 'whole'), 0),
+        'soldOut': lambda product : all(portion['soldOut'] for portion in product['portions']),
+    }
+
+    return [
+        { field: derived[field](product) if field in derived else product[field] for field in fields }
+        for product in products
+    ]
+
+
+def listing_sort_keys (sort, search = None) :
+    '''
+    Builds the sort keys of the product listing for a sorting option.
+
+    Every key list ends with the product id so that the order is total, which keyset pagination relies on.
+    Sorted listings lead with the in stock rank to push sold out products to the bottom, the recommended
+    listing orders by total stock, or by trigram similarity to the search term when searching. Keys use the
+    denormalized product columns so that each order is served by one of the listing indexes on products.
+
+    Args :
+        sort (str) : sorting option ('priceAsc', 'priceDesc', 'nameAsc', 'nameDesc'), anything else is recommended.
+        search (str) : search term, ranks the recommended listing by relevance if present.
+
+    Returns :
+        list : list of (name, expression, descending) tuples, in order of precedence.
+    '''
+    in_stock = Product.total_stock > 0
+
+    sort_options = {
+        'priceAsc': [('inStock', in_stock, True), ('price', Product.whole_price, False), ('id', Product.id, False)],
+        'priceDesc': [('inStock', in_stock, True), ('price', Product.whole_price, True), ('id', Product.id, True)],
+        'nameAsc': [('inStock', in_stock, True), ('name', Product.name, False), ('id', Product.id, False)],
+        'nameDesc': [('inStock', in_stock, True), ('name', Product.name, True), ('id', Product.id, True)],
+    }
+
+    if sort in sort_options :
+        return sort_options[sort]
+
+    if search :
+        # similarity is a real, cast so the cursor's float compares equal to the value it was read from
+        relevance = cast(func.similarity(Product.name, search), Float)
+        return [('relevance', relevance, True), ('stock', Product.total_stock, True), ('id', Product.id, False)]
+
+    return [('stock', Product.total_stock, True), ('id', Product.id, False)]
+
+
+def keyset_condition (sort_keys, values) :
+    '''
+    Builds the filter selecting rows that come after the given sort values, for keys of mixed direction.
+
+    Args :
+        sort_keys (list) : sort keys of the listing, see listing_sort_keys.
+        values (list) : sort values of the last row of the previous page.
+
+    Returns :
+        BooleanClauseList : (k1 after v1) OR (k1 = v1 AND k2 after v2) OR ...
+    '''
+    conditions = []
+
+    for index, (name, expression, descending) in enumerate(sort_keys) :
+        after = expression < values[index] if descending else expression > values[index]
+        conditions.append(and_(*[ sort_keys[i][1] == values[i] for i in range(index) ], after))
+
+    return or_(*conditions)
+
+
+def encode_listing_cursor (sort, sort_keys, values) :
+    '''
+    Encodes the sort values of a row into an opaque, URL safe cursor.
+    '''
+    payload = {
+        'sort': sort,
+        'values': [ str(value) if isinstance(value, Decimal) else value for value in values ]
+    }
+
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_listing_cursor (cursor, sort, sort_keys) :
+    '''
+    Decodes a cursor into sort values.
+
+    Raises :
+        ValueError : if the cursor is malformed or was issued for a different sort.
+    '''
+    try :
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+        if payload['sort'] != sort or len(payload['values']) != len(sort_keys) :
+            raise ValueError('Cursor does not match sort')
+
+        return [ Decimal(value) if name == 'price' else value for (name, expression, descending), value in zip(sort_keys, payload['values']) ]
+
+    except Exception :
+        raise ValueError('Invalid cursor')
+
+
 @product_bp.route('/create', methods = ['POST'])
 @token_required
 def create_product () :
     '''
     Creates a new product along with its associated portions.
 
+    The image is rendered and uploaded in the background after the product is committed,
+    so the response carries the default image until processing finishes.
+
     Request Body :
-    - JSON containing the product details : 'name', 'description', 'category', 'image'.
+    - JSON containing the product details : 'name', 'description', 'category', and optionally 'image'.
     - JSON containing the price details for the portions.
 
     Returns :
     - JSON response containing the created product details and a success message.
     - On authentication failure, returns a 401 status with an error message.
+    - On an image over the upload size limit, returns a 413 status with an error message.
     - On error, returns a 500 status with an error message.
     '''
     try :
@@ -159,10 +546,12 @@ def create_product () :
             
         data = request.form
 
-        if 'image' not in request.files:
-            return jsonify({
-                'error': 'No image file found in request'
-            }), 400
+        # the image can be sent with the form, or uploaded directly to S3 afterwards with a presigned upload
+        file = request.files.get('image')
+
+        if file :
+            validate_image_file(file)
+            image = read_image_file(file)
 
         product_data = {
             key: data.get(key) for key in ['name', 'description', 'category']
@@ -175,17 +564,23 @@ def create_product () :
         portions = new_product.create_portions(data.get('price'))
         db.session.bulk_save_objects(portions)
 
-        file = request.files.get('image')
-        image_url = s3_photo_upload(file, str(new_product.id))
-        new_product.update_attributes({ 'image': image_url })
-
         db.session.commit()
 
+        # renditions are processed in the background, the product keeps its default image until they are uploaded
+        if file :
+            enqueue_product_image(image, new_product.id)
+
         return jsonify({
             'product': new_product.as_dict(),
             'message': 'Product created successfully'
         }), 201
     
+    except RequestEntityTooLarge :
+        db.session.rollback()
+        return jsonify({
+            'error': 'Image file is too large'
+        }), 413
+
     except Exception as error :
         db.session.rollback()
         current_app.logger.error(f'Error creating product: {str(error)}')
@@ -200,6 +595,8 @@ def product_update (id) :
     '''
     Updates the attributes of an existing product.
 
+    A new image is rendered and uploaded in the background after the update is committed.
+
     Request Body :
     - JSON containing the updated product attributes.
 
@@ -207,6 +604,7 @@ def product_update (id) :
     - JSON response containing the updated product details and a success message.
     - On authentication failure, returns a 401 status with an error message.
     - On product not found, returns a 404 status with an error message.
+    - On an image over the upload size limit, returns a 413 status with an error message.
     - On error, returns a 500 status with an error message.
     '''
     try :
@@ -226,19 +624,29 @@ def product_update (id) :
         
         data = { key : value for (key, value) in request.form.items() if key != 'portions' }
 
-        if 'image' in request.files :
-            file = request.files.get('image')
-            image_url = s3_photo_upload(file, str(product.id))
-            data['image'] = image_url
+        file = request.files.get('image')
+
+        if file :
+            validate_image_file(file)
+            image = read_image_file(file)
 
         product.update_attributes(data)
         db.session.commit()
 
+        # renditions are processed in the background, the product keeps its current image until they are uploaded
+        if file :
+            enqueue_product_image(image, product.id)
+
         return jsonify({
             'product': product.as_dict(),
             'message': 'Product updated successfully'
         }), 200
 
+    except RequestEntityTooLarge :
+        return jsonify({
+            'error': 'Image file is too large'
+        }), 413
+
     except Exception as error :
         current_app.logger.error(f'Error updating product: {str(error)}')
         return jsonify({
@@ -246,6 +654,113 @@ def product_update (id) :
         }), 500
 
 
+@product_bp.route('/<int:id>/image/upload-url', methods = ['POST'])
+@token_required
+def product_image_upload_url (id) :
+    '''
+    Issues a presigned upload so the client can send a product photo straight to S3.
+
+    Request Body :
+    - JSON containing 'fileName' of the photo to upload.
+
+    Returns :
+    - JSON response containing the upload URL, the form fields to post with the file, and the upload key.
+    - On authentication failure, returns a 401 status with an error message.
+    - On product not found, returns a 404 status with an error message.
+    - On invalid file type, returns a 400 status with an error message.
+    - On error, returns a 500 status with an error message.
+    '''
+    try :
+        admin = request.admin
+
+        if admin.role == Role.GENERAL :
+            return jsonify({
+                'error': 'Forbidden'
+            }), 403
+
+        if not Product.query.get(id) :
+            return jsonify({
+                'error': 'Product not found'
+            }), 404
+
+        file_name = (request.get_json(silent = True) or {}).get('fileName')
+
+        if not file_name :
+            return jsonify({
+                'error': 'No file name provided'
+            }), 400
+
+        try :
+            upload = presign_image_upload(id, file_name)
+        except ValueError as error :
+            if str(error) != 'Invalid file type' :
+                raise
+            return jsonify({
+                'error': str(error)
+            }), 400
+
+        return jsonify({
+            'upload': upload
+        }), 200
+
+    except Exception as error :
+        current_app.logger.error(f'Error presigning image upload: {str(error)}')
+        return jsonify({
+            'error': 'Internal server error'
+        }), 500
+
+
+@product_bp.route('/<int:id>/image/complete', methods = ['POST'])
+@token_required
+def product_image_upload_complete (id) :
+    '''
+    Starts processing a product photo uploaded directly to S3. The renditions are rendered from the uploaded
+    object in the background, and the product's image is updated once they are uploaded.
+
+    Request Body :
+    - JSON containing the upload 'key' returned with the presigned upload.
+
+    Returns :
+    - JSON response with a message, with a 202 status since processing continues in the background.
+    - On authentication failure, returns a 401 status with an error message.
+    - On product not found, returns a 404 status with an error message.
+    - On a key not issued for this product or a missing upload, returns a 400 status with an error message.
+    - On error, returns a 500 status with an error message.
+    '''
+    try :
+        admin = request.admin
+
+        if admin.role == Role.GENERAL :
+            return jsonify({
+                'error': 'Forbidden'
+            }), 403
+
+        if not Product.query.get(id) :
+            return jsonify({
+                'error': 'Product not found'
+            }), 404
+
+        key = (request.get_json(silent = True) or {}).get('key') or ''
+
+        # only uploads presigned for this product can be processed for it
+        if not key.startswith(upload_key_prefix(id)) or not s3_object_exists(key) :
+            return jsonify({
+                'error': 'Upload not found'
+            }), 400
+
+        enqueue_uploaded_product_image(key, id)
+
+        return jsonify({
+            'message': 'Image processing started'
+        }), 202
+
+    except Exception as error :
+        current_app.logger.error(f'Error completing image upload: {str(error)}')
+        return jsonify({
+            'error': 'Internal server error'
+        }), 500
+
+
 @product_bp.route('/inventory/generate-report', methods = ['GET'])
 @token_required
 def product_generate_inventory_report () :
@@ -253,6 +768,9 @@ def product_generate_inventory_report () :
     Generates a report of products that need inventory restocking based on 
     portion stock levels.
 
+    The report is computed and serialized entirely in SQL, reading only the low stock portions
+    through a partial index, so its cost follows the number of low stock portions rather than the catalog.
+
     Returns :
     - JSON response containing a list of products with low stock and the portions 
       that need restocking.
@@ -263,43 +781,44 @@ def product_generate_inventory_report () :
     try :
         # retrieve token and auth user
         admin = request.admin
-        
-        low_stock_products = (Product.query
-            .join(Product.portions)
-            .filter(Portion.stock < (Portion.optimal_stock - 5)) # filtering where stock is below ideal threshold
-            .distinct()  # ensures product only comes up once
-            .options(joinedload(Product.portions))
-            .all()
+
+        # low stock portions grouped per product, read through the partial index on the same condition. the margin
+        # is inlined rather than bound, so the planner can match the query against the index predicate
+        low_stock_portions = (
+            select(
+                Portion.product_id.label('product_id'),
+                func.json_agg(aggregate_order_by(portion_json_object(), Portion.id)).label('portions'),
+                func.json_object_agg(Portion.id, Portion.optimal_stock - Portion.stock).label('restock'),
+            )
+            .where(Portion.stock < Portion.optimal_stock - literal_column(str(restock_margin)))
+            .group_by(Portion.product_id)
+            .subquery()
         )
-        
-        products_list = []
-        portions_to_update = {}
-
-        for product in low_stock_products :
-            # filter for portions based on stock criteria 
-            filtered_portions = [
-                portion for portion in product.portions
-                if portion.stock < (portion.optimal_stock - 5)
-            ]
-            
-            if filtered_portions :
-                # update product with list of filtered portions and convert to dict
-                product.portions = filtered_portions
-                products_list.append(product.as_dict())
 
-                # construct the updatedPortionsState structure with the portions that need stock updates for frontend
-                if product.id not in portions_to_update :
-                    portions_to_update[product.id] = {}
+        product_json = func.json_build_object(
+            'id', Product.id,
+            'name', Product.name,
+            'description', Product.description,
+            'category', func.lower(cast(Product.category, String)),
+            'image', Product.image,
+            'portions', low_stock_portions.c.portions,
+        )
 
-                for portion in filtered_portions :
-                    portions_to_update[product.id][portion.id] = portion.optimal_stock - portion.stock
+        # products with only their low stock portions, and the restock quantities for the frontend
+        products, portions_to_update = db.session.execute(
+            select(
+                cast(func.coalesce(func.json_agg(aggregate_order_by(product_json, Product.id)), literal_column("'[]'::json")), Text),
+                cast(func.coalesce(func.json_object_agg(Product.id, low_stock_portions.c.restock), literal_column("'{}'::json")), Text),
+            )
+            .select_from(low_stock_portions)
+            .join(Product, Product.id == low_stock_portions.c.product_id)
+        ).one()
 
+        return current_app.response_class(
+            f'{{"products": {products}, "updatedPortionsState": {portions_to_update}}}',
+            mimetype = 'application/json'
+        ), 200
 
-        return jsonify({
-            'products': products_list,
-            'updatedPortionsState': portions_to_update
-        }), 200
-        
 
     except Exception as error :
         current_app.logger.error(f'Error generating inventory report: {str(error)}')
@@ -318,6 +837,9 @@ def product_update_inventory () :
     Request Body :
     - JSON containing the product IDs, portion IDs, and the new stock values.
 
+    The whole payload is applied with one set-based update. If any product or portion is missing,
+    nothing is updated and every missing ID is reported.
+
     Returns :
     - JSON response with a success message when the inventory is updated successfully.
     - On authentication failure, returns a 401 status with an error message.
@@ -329,23 +851,22 @@ def product_update_inventory () :
         data = request.get_json()
 
         try :
-            # loop over data, and extract the product id key, portion id and new stock value
-            for product_id, portions in data.items() :
-                # retrieve product
-                product = Product.query.get(int(product_id))
-                if product :
-                    for portion_id, new_stock in portions.items() :
-                        # retrieve portion and update stock
-                        portion = next((p for p in product.portions if p.id == int(portion_id)), None)
-                        if portion :
-                            portion.update_stock(portion.stock + int(new_stock))
-                        
-                        else :
-                            raise ValueError(f'Portion with id {portion_id} was not found')
-                        
-                else :
-                    raise ValueError(f'Product with id {product_id} was not found')
-            
+            # flatten the payload into (product id, portion id, added stock) rows
+            rows = [
+                (int(product_id), int(portion_id), int(new_stock))
+                for product_id, portions in data.items()
+                for portion_id, new_stock in portions.items()
+            ]
+
+            updated = Portion.add_stock(rows)
+
+            # stock changes can move products between listing pages, invalidate every affected product in one pass
+            mark_products_changed(
+                db.session,
+                { product_id for product_id, category, stock in updated.values() },
+                { category.value for product_id, category, stock in updated.values() },
+            )
+
             # commit the transaction
             db.session.commit()
 
@@ -365,29 +886,140 @@ def product_update_inventory () :
         }), 500
 
 
+@product_bp.route('/inventory/stock', methods = ['GET'])
+@token_required
+def product_inventory_stock_at () :
+    '''
+    Reconstructs the stock of every portion at a point in time from the inventory ledger, starting from
+    the latest snapshot before that time rather than replaying the whole ledger.
+
+    Query Parameters :
+    - at (str) : ISO 8601 UTC timestamp to reconstruct stock at, defaults to now.
+    - portionIds (str) : optional comma separated portion IDs to restrict the result to.
+
+    Returns :
+    - JSON response containing the timestamp and the stock keyed by product ID, then portion ID.
+    - On authentication failure, returns a 401 status with an error message.
+    - On an invalid timestamp or portion ID, returns a 400 status with an error message.
+    - On error, returns a 500 status with an error message.
+    '''
+    try :
+        admin = request.admin
+
+        try :
+            at = datetime.fromisoformat(request.args['at']) if request.args.get('at') else datetime.now(timezone.utc)
+            portion_ids = [ int(id) for id in request.args.get('portionIds', '').split(',') if id.strip() ]
+
+        except ValueError :
+            return jsonify({
+                'error': 'Invalid timestamp or portion IDs'
+            }), 400
+
+        # timestamps are stored as naive UTC
+        if at.tzinfo is not None :
+            at = at.astimezone(timezone.utc).replace(tzinfo = None)
+
+        stock = {}
+        for portion_id, product_id, portion_stock in stock_at(at, portion_ids) :
+            stock.setdefault(product_id, {})[portion_id] = portion_stock
+
+        return jsonify({
+            'at': at.isoformat(),
+            'stock': stock
+        }), 200
+
+    except Exception as error :
+        current_app.logger.error(f'Error reconstructing inventory: {str(error)}')
+        return jsonify({
+            'error': 'Internal server error'
+        }), 500
+
+
+# most products resolved by one batch request
+max_batch_size = 100
+
+@product_bp.route('/batch', methods = ['GET'])
+def product_batch () :
+    '''
+    Retrieves the details of many products by their IDs, resolving cached products with a single
+    cache lookup and the rest with a single database query.
+
+    Query Parameters :
+    - ids (str) : comma separated product ids.
+
+    Returns :
+    - JSON response containing the products in the order of the requested ids. Ids that do not
+      match a product are returned as { id, error } markers.
+    - On missing, invalid or too many ids, returns a 400 status with an error message.
+    - On error, returns a 500 status with an error message.
+    '''
+    try :
+        try :
+            ids = [ int(id) for id in request.args.get('ids', '').split(',') if id.strip() ]
+        except ValueError :
+            return jsonify({
+                'error': 'Product ids must be integers'
+            }), 400
+
+        if not ids :
+            return jsonify({
+                'error': 'No product ids provided'
+            }), 400
+
+        if len(ids) > max_batch_size :
+            return jsonify({
+                'error': f'At most {max_batch_size} products can be requested at once'
+            }), 400
+
+        unique_ids = list(dict.fromkeys(ids))
+
+        cached, missing_ids = get_products_cache(unique_ids)
+        products = { product['id']: product for product in hydrate_products(unique_ids, cached, missing_ids) }
+
+        return jsonify({
+            'products': [ products.get(id, { 'id': id, 'error': 'Product not found' }) for id in ids ]
+        }), 200
+
+    except Exception as error :
+        current_app.logger.error(f'Error fetching products: {str(error)}')
+        return jsonify({
+            'error': 'Internal server error'
+        }), 500
+
+
 @product_bp.route('/<int:id>', methods = ['GET'])
+@etag_cached(lambda id : f'product-{id}-{get_product_revision(id)}')
 def product_show (id) :
     '''
     Retrieves the details of a specific product by its ID.
 
     Returns :
     - JSON response containing the product details.
+    - If If-None-Match matches the product's revision, returns a 304 status without a body.
     - On product not found, returns a 404 status with an error message.
     - On error, returns a 500 status with an error message.
     '''
     try :
-        product = get_product_cache(id)
+        # pass the cached JSON through without decoding it
+        cached_product = get_product_cache_raw(id)
 
-        if not product :
-            product = Product.query.get(id)
-            if product :
-                product = product.as_dict()
+        if cached_product :
+            return raw_json_response('product', cached_product)
+
+        revisions = get_product_revisions([id])
+
+        product = Product.query.get(id)
+        if product :
+            product = product.as_dict()
 
         if not product :
             return jsonify({
                 'error': 'Product not found'
             }), 404
 
+        # write the product back into the catalog generation, it was purged by a change or is new since the rebuild
+        cache_product_entries([product], revisions)
+
         return jsonify({
             'product': product
         }), 200
@@ -397,4 +1029,34 @@ def product_show (id) :
         current_app.logger.error(f'Error fetching product: {str(error)}')
         return jsonify({
             'error': 'Internal server error'
-        }), 500
\ No newline at end of file
+        }), 500
+
+
+def hydrate_products (ids, cached_products, missing_ids) :
+    '''
+    Assembles an ordered list of product dictionaries from cached entries, refilling any
+    cache misses from the database with a single query and writing them back to cache.
+
+    Args :
+        ids (list) : ordered ids of the products to return.
+        cached_products (dict) : product dictionaries found in cache, keyed by id.
+        missing_ids (list) : ids that were not found in cache.
+
+    Returns :
+        list : product dictionaries in the order of ids, skipping products that no longer exist.
+    '''
+    if missing_ids :
+        # revisions are read before loading, so products changed meanwhile are not written back stale
+        revisions = get_product_revisions(missing_ids)
+
+        refilled = [
+            product.as_dict() for product in Product.query
+                .filter(Product.id.in_(missing_ids))
+                .options(selectinload(Product.portions))
+                .all()
+        ]
+        cache_product_entries(refilled, revisions)
+
+        cached_products = { **cached_products, **{ product['id']: product for product in refilled } }
+
+    return [ cached_products[id] for id in ids if id in cached_products ]
@@ -1 +1,2 @@
-from .auth import token_required
\ No newline at end of file
+from .auth import token_required
+from .http_cache import etag_cached
\ No newline at end of file
@@ -0,0 +1,43 @@
+from functools import wraps
+from flask import request, current_app, make_response
+
+
+def etag_cached (get_etag) :
+    '''
+    Makes a GET endpoint conditional on a strong ETag.
+
+    The ETag is derived before the view runs, so a request whose If-None-Match matches is answered
+    with 304 Not Modified without running the view. Successful responses carry the ETag and a
+    Cache-Control header that shared caches can honour, using `CATALOG_CACHE_MAX_AGE` from app configuration.
+
+    Args :
+        get_etag (callable) : receives the view arguments and returns the ETag for the current request.
+    '''
+    def decorator (f) :
+        @wraps(f)
+        def decorated_function (*args, **kwargs) :
+            try :
+                etag = get_etag(*args, **kwargs)
+
+            except Exception as error :
+                # serve the request uncached rather than failing it
+                current_app.logger.error(f'Error deriving ETag: {str(error)}')
+                return f(*args, **kwargs)
+
+            if request.if_none_match.contains(etag) :
+                response = make_response('', 304)
+
+            else :
+                response = make_response(f(*args, **kwargs))
+
+                if response.status_code != 200 :
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = f"public, max-age={current_app.config['CATALOG_CACHE_MAX_AGE']}, must-revalidate"
+
+            return response
+
+        return decorated_function
+
+    return decorator
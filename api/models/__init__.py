@@ -9,3 +9,6 @@ from .address import Address
 from .cart_item import Cart_Item
 from .order import Order
 from .task import Task
+from .inventory import Inventory_Movement
+from .inventory import Inventory_Snapshot
+from .inventory import Movement_Kind
@@ -2,7 +2,8 @@ from sqlalchemy import CheckConstraint, and_, or_
 from decimal import Decimal, ROUND_CEILING
 
 from .product import Product
-from .portion import Portion
+from .portion import Portion, Portion_Size
+from .serializer import Serializer, label, decimal, nested
 
 from ...database import db
 
@@ -147,19 +148,25 @@ class Cart_Item (db.Model) :
         Returns :
             dict : dictionary representation of the cart_item, including product and portion details. NOTE: camelCasing for ease in frontend.
         '''
-        return {
-            'id': self.id,
-            'product': {
-                'id': self.product.id,
-                'name': self.product.name,
-                'image': self.product.image
-            },
-            'price': float(self.price),
-            'portion': {
-                'id': self.portion.id,
-                'size': self.portion.size.value.lower(),
-                'price': float(self.portion.price)
-            },
-            'quantity': self.quantity,
-            'orderId': self.order_id
-        }
\ No newline at end of file
+        return cart_item_serializer(self)
+
+
+# summary of the product a cart item is for
+cart_item_product_serializer = Serializer({
+    'id': 'id',
+    'name': 'name',
+    'image': 'image',
+})
+
+cart_item_serializer = Serializer({
+    'id': 'id',
+    'product': nested('product', cart_item_product_serializer),
+    'price': decimal('price'),
+    'portion': nested('portion', Serializer({
+        'id': 'id',
+        'size': label('size', Portion_Size),
+        'price': decimal('price'),
+    })),
+    'quantity': 'quantity',
+    'orderId': 'order_id',
+})
@@ -0,0 +1,197 @@
+from enum import Enum
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, insert, func, and_, literal, true
+
+from ...database import db
+
+
+class Movement_Kind (Enum) :
+    '''
+    Enum for representing the reason of an inventory movement.
+
+    Attributes :
+        RESTOCK (str) : stock added by an inventory update.
+        SALE (str) : stock reserved for an order.
+        ADJUSTMENT (str) : stock set directly, including opening balances.
+    '''
+    RESTOCK = 'RESTOCK'
+    SALE = 'SALE'
+    ADJUSTMENT = 'ADJUSTMENT'
+
+
+class Inventory_Movement (db.Model) :
+    '''
+    Represents a change to a portion's stock in the append-only inventory ledger.
+
+    Every stock write appends a movement in the same statement or transaction, so the sum of a portion's
+    movements equals its stock. Portion.stock is kept as the materialized balance of the ledger.
+
+    Attributes :
+        id (int) : unique identifier for the movement.
+        portion_id (int) : ID of the portion whose stock changed.
+        quantity (int) : signed change to the portion's stock.
+        kind (Movement_Kind) : reason of the change.
+        created_at (datetime) : UTC time of the transaction that made the change.
+    '''
+    __tablename__ = 'inventory_movements'
+
+    id = db.Column(db.BigInteger, primary_key = True)
+    portion_id = db.Column(db.Integer, db.ForeignKey('portions.id', ondelete = 'CASCADE'), nullable = False)
+    quantity = db.Column(db.Integer, nullable = False)
+    kind = db.Column(db.Enum(Movement_Kind), nullable = False)
+    created_at = db.Column(db.TIMESTAMP(), nullable = False, server_default = db.text("(now() at time zone 'utc')"))
+
+    __table_args__ = (
+        db.Index('ix_inventory_movements_portion_created_at', 'portion_id', 'created_at'),
+    )
+
+    portion = db.relationship('Portion')
+
+    def __init__ (self, portion, quantity, kind) :
+        '''
+        Initializes a new inventory movement instance.
+
+        Args :
+            portion (Portion) : portion whose stock changed.
+            quantity (int) : signed change to the portion's stock.
+            kind (Movement_Kind) : reason of the change.
+        '''
+        self.portion = portion
+        self.quantity = quantity
+        self.kind = kind
+
+    @staticmethod
+    def logged (updated, kind) :
+        '''
+        Builds a CTE appending a movement for every row of a stock UPDATE ... RETURNING CTE, so a bulk stock
+        write and its ledger entries are a single statement.
+
+        Args :
+            updated (CTE) : stock update returning the portion 'id' and the signed 'quantity' it changed by.
+            kind (Movement_Kind) : reason of the changes.
+
+        Returns :
+            CTE : the insert, to be attached to the statement selecting from updated.
+        '''
+        return insert(Inventory_Movement.__table__).from_select(
+            ['portion_id', 'quantity', 'kind'],
+            select(updated.c.id, updated.c.quantity, literal(kind, Inventory_Movement.kind.type))
+                .where(updated.c.quantity != 0),
+        ).cte('logged')
+
+
+class Inventory_Snapshot (db.Model) :
+    '''
+    Represents a portion's stock at a point in time, folded from the ledger so point-in-time stock
+    only replays the movements after the latest snapshot.
+
+    Attributes :
+        id (int) : unique identifier for the snapshot.
+        portion_id (int) : ID of the portion.
+        stock (int) : stock of the portion at taken_at.
+        taken_at (datetime) : UTC time the snapshot covers movements up to.
+    '''
+    __tablename__ = 'inventory_snapshots'
+
+    id = db.Column(db.BigInteger, primary_key = True)
+    portion_id = db.Column(db.Integer, db.ForeignKey('portions.id', ondelete = 'CASCADE'), nullable = False)
+    stock = db.Column(db.Integer, nullable = False)
+    taken_at = db.Column(db.TIMESTAMP(), nullable = False)
+
+    __table_args__ = (
+        db.Index('ix_inventory_snapshots_portion_taken_at', 'portion_id', 'taken_at'),
+    )
+
+
+def _stock_at (portion_ids, at, changed_only = False) :
+    '''
+    Builds a query of (portion ID, product ID, stock at the given time), starting from each portion's latest
+    snapshot at or before that time and adding the movements after it. With `changed_only`, portions without
+    movements since that snapshot are left out.
+    '''
+    from .portion import Portion
+
+    snapshot = (select(Inventory_Snapshot.stock, Inventory_Snapshot.taken_at)
+        .where(Inventory_Snapshot.portion_id == Portion.id, Inventory_Snapshot.taken_at <= at)
+        .order_by(Inventory_Snapshot.taken_at.desc())
+        .limit(1)
+        .lateral('snapshot')
+    )
+
+    since_snapshot = and_(
+        Inventory_Movement.portion_id == Portion.id,
+        Inventory_Movement.created_at <= at,
+        Inventory_Movement.created_at > func.coalesce(snapshot.c.taken_at, literal(datetime.min)),
+    )
+
+    replayed = select(func.coalesce(func.sum(Inventory_Movement.quantity), 0)).where(since_snapshot).scalar_subquery()
+
+    query = (select(Portion.id, Portion.product_id, (func.coalesce(snapshot.c.stock, 0) + replayed).label('stock'))
+        .outerjoin(snapshot, true())
+        .order_by(Portion.id)
+    )
+
+    if portion_ids :
+        query = query.where(Portion.id.in_(portion_ids))
+
+    if changed_only :
+        query = query.where(select(Inventory_Movement.id).where(since_snapshot).exists())
+
+    return query
+
+
+def stock_at (at, portion_ids = None) :
+    '''
+    Reconstructs the stock of portions at a point in time from the inventory ledger.
+
+    Args :
+        at (datetime) : UTC time to reconstruct stock at.
+        portion_ids (list) : IDs of the portions, or None for every portion.
+
+    Returns :
+        list : (portion ID, product ID, stock) rows ordered by portion ID.
+    '''
+    return db.session.execute(_stock_at(portion_ids, at)).all()
+
+
+def snapshot_inventory (lag = timedelta(minutes = 5)) :
+    '''
+    Compacts the ledger by writing a snapshot of the stock of every portion with movements since its previous
+    snapshot, so point-in-time queries replay at most the movements since then. Portions that did not move keep
+    their previous snapshot, which still holds their stock.
+
+    Snapshots are taken `lag` in the past, so transactions that were still open when the job started
+    have committed their movements before the cutoff is read. Also reports portions whose materialized
+    stock disagrees with the ledger.
+
+    Args :
+        lag (timedelta) : how far in the past the snapshot is taken.
+
+    Returns :
+        tuple : number of snapshots written, and list of IDs of the portions whose stock drifted from the ledger.
+    '''
+    from .portion import Portion
+
+    taken_at = datetime.now(timezone.utc).replace(tzinfo = None) - lag
+
+    folded = _stock_at(None, taken_at, changed_only = True).subquery()
+
+    written = db.session.execute(
+        insert(Inventory_Snapshot).from_select(
+            ['portion_id', 'stock', 'taken_at'],
+            select(folded.c.id, folded.c.stock, literal(taken_at)),
+        )
+    ).rowcount
+
+    # the ledger balance now is the new snapshot plus the movements after it
+    balance = _stock_at(None, datetime.now(timezone.utc).replace(tzinfo = None) + timedelta(days = 1)).subquery()
+
+    drifted = list(db.session.scalars(
+        select(Portion.id)
+            .join(balance, and_(balance.c.id == Portion.id, balance.c.stock != Portion.stock))
+            .order_by(Portion.id)
+    ))
+
+    db.session.commit()
+
+    return written, drifted
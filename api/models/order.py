@@ -3,6 +3,8 @@ from enum import Enum
 from datetime import datetime, timezone
 
 from .task import Task
+from .cart_item import cart_item_serializer
+from .serializer import Serializer, label, timestamp, many
 
 from ...database import db
 
@@ -232,13 +234,16 @@ class Order (db.Model) :
         Returns :
             dict : dictionary representation of the order, including associated cart_items and address. NOTE: camelCasing for ease in frontend.
         '''
-        return {
-            'id': self.id,
-            'totalPrice': self.total_price,
-            'date': self.date.strftime('%m/%d/%Y %I:%M %p'),
-            'cartItems': [ item.as_dict() for item in self.cart_items ],
-            'status': self.status.value.lower(),
-            'deliveryMethod': self.delivery_method.value.lower(),
-            'paymentStatus': self.payment_status.value.lower(),
-            'address': self.address.as_dict(),
-        }
+        return order_serializer(self)
+
+
+order_serializer = Serializer({
+    'id': 'id',
+    'totalPrice': 'total_price',
+    'date': timestamp('date'),
+    'cartItems': many('cart_items', cart_item_serializer),
+    'status': label('status', Order_Status),
+    'deliveryMethod': label('delivery_method', Deliver_Method),
+    'paymentStatus': label('payment_status', Pay_Status),
+    'address': lambda order : order.address.as_dict(),
+})
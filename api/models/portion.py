@@ -1,7 +1,10 @@
 from enum import Enum
-from sqlalchemy import CheckConstraint
+from sqlalchemy import CheckConstraint, Integer, update, values, column, select
 from decimal import Decimal, ROUND_DOWN
 
+from .serializer import Serializer, label, decimal
+from .inventory import Inventory_Movement, Movement_Kind
+
 from ...database import db
 
 
@@ -18,6 +21,9 @@ class Portion_Size (Enum) :
     WHOLE = 'WHOLE'
     MINI = 'MINI'
 
+# portions more than this far below their optimal stock need restocking, matched by the ix_portions_needs_restock predicate
+restock_margin = 5
+
 class Portion (db.Model) :
     '''
     Represents a portion of a product.
@@ -30,11 +36,13 @@ class Portion (db.Model) :
         stock (int) : current stock level of the portion.
         price (Decimal) : price of the portion.
         product (relationship) : relationship to the product to which the portion belongs.
+
+    Inserting, updating or deleting a portion refreshes the product's total_stock and whole_price via a database trigger.
     '''
     __tablename__ = 'portions'
 
     id = db.Column(db.Integer, primary_key = True)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable = False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable = False, index = True)
     size = db.Column(db.Enum(Portion_Size), nullable = False)
     optimal_stock = db.Column(db.Integer, default = 10, nullable = False)
     stock = db.Column(db.Integer, nullable = False)
@@ -44,6 +52,9 @@ class Portion (db.Model) :
         # ensures that stock and price as equal or greater than 0
         CheckConstraint('stock >= 0', name = 'non_negative_stock'),
         CheckConstraint('price >= 0', name = 'non_negative_price'),
+
+        # partial index holding only the portions that need restocking, for the inventory report
+        db.Index('ix_portions_needs_restock', 'product_id', 'id', postgresql_where = db.text(f'stock < optimal_stock - {restock_margin}')),
     )
 
     # define relationship
@@ -98,8 +109,141 @@ class Portion (db.Model) :
         Args :
             new_stock (int) : new stock level for the portion.
         '''
+        # recorded as an adjustment in the inventory ledger, flushed with the portion
+        if new_stock != self.stock :
+            db.session.add(Inventory_Movement(self, new_stock - (self.stock or 0), Movement_Kind.ADJUSTMENT))
+
         self.stock = new_stock
 
+    @staticmethod
+    def reserve_stock (quantities) :
+        '''
+        Decrements the stock of many portions in a single conditional UPDATE, without reading stock first.
+
+        Each portion is only decremented if it holds at least the requested quantity, so concurrent reservations
+        cannot oversell or lose updates. The reservation is all or nothing : if any portion falls short, none are
+        decremented. A sale is appended to the inventory ledger for every decrement in the same statement.
+
+        The trigger keeping products.total_stock in sync updates the product row of every decremented portion,
+        so the products are locked in id order first, see lock_products. Updated portions and their products
+        stay locked until the transaction ends.
+
+        Writes bypass the ORM unit of work, callers must mark the affected products as changed for cache invalidation.
+
+        Args :
+            quantities (dict) : quantity to reserve keyed by portion ID.
+
+        Returns :
+            tuple : dictionary of (product ID, remaining stock) keyed by reserved portion ID, and list of
+                IDs of the portions that could not be fulfilled (empty if the reservation succeeded).
+        '''
+        if not quantities :
+            return {}, []
+
+        requested = values(column('id', Integer), column('quantity', Integer), name = 'requested').data(
+            sorted(quantities.items())
+        )
+
+        portions = Portion.__table__
+
+        updated = (update(portions)
+            .where(portions.c.id == requested.c.id, portions.c.stock >= requested.c.quantity)
+            .values(stock = portions.c.stock - requested.c.quantity)
+            .returning(portions.c.id, portions.c.product_id, portions.c.stock, (-requested.c.quantity).label('quantity'))
+            .cte('updated')
+        )
+
+        statement = (select(updated.c.id, updated.c.product_id, updated.c.stock)
+            .add_cte(Inventory_Movement.logged(updated, Movement_Kind.SALE))
+        )
+
+        savepoint = db.session.begin_nested()
+
+        lock_products(quantities)
+
+        reserved = { id: (product_id, stock) for id, product_id, stock in db.session.execute(statement) }
+        unfulfilled = [ id for id in quantities if id not in reserved ]
+
+        if unfulfilled :
+            savepoint.rollback()
+            return {}, unfulfilled
+
+        savepoint.commit()
+        return reserved, []
+
+    @staticmethod
+    def add_stock (rows, kind = Movement_Kind.RESTOCK) :
+        '''
+        Adds stock to many portions in a single UPDATE ... FROM (VALUES ...) statement, appending a movement
+        to the inventory ledger for every change in the same statement.
+
+        Rows that do not match a portion of the given product are reported together, in which case nothing
+        is updated. Products are locked in id order first, see lock_products. Writes bypass the ORM unit of work, callers must mark the affected products as changed
+        for cache invalidation.
+
+        Args :
+            rows (list) : (product ID, portion ID, quantity) tuples, quantity may be negative.
+            kind (Movement_Kind) : reason of the changes, recorded in the ledger.
+
+        Returns :
+            dict : (product ID, product category, new stock) keyed by updated portion ID.
+
+        Raises :
+            LookupError : if any product or portion was not found, listing every missing ID.
+        '''
+        if not rows :
+            return {}
+
+        from .product import Product
+
+        restock = values(
+            column('product_id', Integer), column('portion_id', Integer), column('quantity', Integer), name = 'restock'
+        ).data(sorted(rows, key = lambda row : row[1]))
+
+        portions, products = Portion.__table__, Product.__table__
+
+        updated = (update(portions)
+            .where(
+                portions.c.id == restock.c.portion_id,
+                portions.c.product_id == restock.c.product_id,
+                products.c.id == portions.c.product_id,
+            )
+            .values(stock = portions.c.stock + restock.c.quantity)
+            .returning(portions.c.id, portions.c.product_id, products.c.category, portions.c.stock, restock.c.quantity)
+            .cte('updated')
+        )
+
+        statement = (select(updated.c.id, updated.c.product_id, updated.c.category, updated.c.stock)
+            .add_cte(Inventory_Movement.logged(updated, kind))
+        )
+
+        savepoint = db.session.begin_nested()
+
+        lock_products([ row[1] for row in rows ])
+
+        updated = { id: (product_id, category, stock) for id, product_id, category, stock in db.session.execute(statement) }
+
+        if len(updated) == len(rows) :
+            savepoint.commit()
+            return updated
+
+        savepoint.rollback()
+
+        # a single lookup tells missing products apart from portions missing from their product
+        requested_products = { row[0] for row in rows }
+        found_products = set(db.session.scalars(select(Product.id).where(Product.id.in_(requested_products))))
+
+        missing_products = sorted(requested_products - found_products)
+        missing_portions = sorted({ portion_id for product_id, portion_id, quantity in rows if product_id in found_products and portion_id not in updated })
+
+        errors = []
+        if missing_products :
+            errors.append(f"Products with ids {', '.join(map(str, missing_products))} were not found")
+        if missing_portions :
+            errors.append(f"Portions with ids {', '.join(map(str, missing_portions))} were not found")
+
+        raise LookupError('; '.join(errors))
+
     def as_dict (self) :
         '''
         Converts the portion to a dictionary.
@@ -107,11 +251,37 @@ class Portion (db.Model) :
         Returns :
             dict : dictionary representation of the portion, including attributes and soldOut status. NOTE: camelCasing for ease in frontend.
         '''
-        return {
-            'id': self.id,
-            'size': self.size.value.lower(),
-            'optimalStock': self.optimal_stock,
-            'stock': self.stock,
-            'price': float(self.price),
-            'soldOut': True if self.stock == 0 else False
-        }
\ No newline at end of file
+        return portion_serializer(self)
+
+
+def lock_products (portion_ids) :
+    '''
+    Locks the product rows of the given portions in product id order, until the transaction ends.
+
+    Stock writes fire the trigger that refreshes products.total_stock, which locks each product in the order
+    the portions happen to be processed. Two transactions touching the same products in opposite orders would
+    deadlock, taking every lock up front in a consistent order makes them queue instead.
+
+    Args :
+        portion_ids (iterable) : IDs of the portions about to be written.
+    '''
+    from .product import Product
+
+    portions = Portion.__table__
+
+    db.session.execute(
+        select(Product.id)
+            .where(Product.id.in_(select(portions.c.product_id).where(portions.c.id.in_(list(portion_ids)))))
+            .order_by(Product.id)
+            .with_for_update()
+    )
+
+
+portion_serializer = Serializer({
+    'id': 'id',
+    'size': label('size', Portion_Size),
+    'optimalStock': 'optimal_stock',
+    'stock': 'stock',
+    'price': decimal('price'),
+    'soldOut': lambda portion : portion.stock == 0,
+})
@@ -1,6 +1,7 @@
 from enum import Enum
 from sqlalchemy import CheckConstraint
-from .portion import Portion, Portion_Size
+from .portion import Portion, Portion_Size, portion_serializer
+from .serializer import Serializer, label, many, number
 
 from ...database import db
 
@@ -35,6 +36,8 @@ class Product (db.Model) :
         description (str) : description of the product.
         category (Category) : category of the product.
         image (str) : URL of the product image.
+        total_stock (int) : sum of the stock of the product's portions, maintained by a database trigger on portions.
+        whole_price (Decimal) : price of the product's whole portion, maintained by a database trigger on portions.
         portions (relationship) : relationship to portions associated with the product.
     '''
     __tablename__ = 'products'
@@ -45,13 +48,29 @@ class Product (db.Model) :
     category = db.Column(db.Enum(Category), nullable = False)
     image = db.Column(db.String(), nullable = False, default = 'https://example.com/default_image.jpg')
 
+    # denormalized from portions for listing sorts, never written by the application
+    total_stock = db.Column(db.Integer, nullable = False, server_default = '0')
+    whole_price = db.Column(db.Numeric(precision = 5, scale = 2), nullable = False, server_default = '0')
+
     __table_args__ = (
         # validation for image url string
         CheckConstraint("image ~* '^https?://.*\.(png|jpg|jpeg|gif)$'", name = 'valid_image_url'),
+
+        # cover the listing sort orders, in stock products first. the in stock expression is spelled out as text,
+        # Postgres needs it parenthesized in an index definition
+        db.Index('ix_products_listing_stock', total_stock.desc(), id),
+        db.Index('ix_products_listing_price_asc', db.text('(total_stock > 0) DESC'), whole_price, id),
+        db.Index('ix_products_listing_price_desc', db.text('(total_stock > 0) DESC'), whole_price.desc(), id.desc()),
+        db.Index('ix_products_listing_name_asc', db.text('(total_stock > 0) DESC'), name, id),
+        db.Index('ix_products_listing_name_desc', db.text('(total_stock > 0) DESC'), name.desc(), id.desc()),
+
+        # trigram index to serve substring search on name, requires the pg_trgm extension
+        db.Index('ix_products_name_trgm', name, postgresql_using = 'gin', postgresql_ops = { 'name': 'gin_trgm_ops' }),
     )
 
     # defines relationship
-    portions = db.relationship('Portion', back_populates = 'product', cascade = 'all, delete-orphan')
+    # ordered by id so that serialized portions keep a stable order, matching the listing built in SQL
+    portions = db.relationship('Portion', back_populates = 'product', cascade = 'all, delete-orphan', order_by = 'Portion.id')
 
     def __init__ (self, name, description, category) :
         '''
@@ -114,11 +133,40 @@ class Product (db.Model) :
         Returns :
             dict : dictionary representation of the product, including associated portions. NOTE: camelCasing for ease in frontend.
         '''
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'category': self.category.value.lower(),
-            'image': self.image,
-            'portions': [ portion.as_dict() for portion in self.portions ]
+        return product_serializer(self)
+
+    def as_projection (self, fields) :
+        '''
+        Converts the product to a dictionary holding only the requested fields, reading only the attributes
+        backing them so that the remaining columns and portions can stay unloaded.
+
+        Args :
+            fields (list) : field names among 'id', 'name', 'description', 'category', 'image', 'price', 'soldOut' and 'portions'.
+
+        Returns :
+            dict : dictionary representation of the requested fields. NOTE: camelCasing for ease in frontend.
+        '''
+        values = {
+            'id': lambda : self.id,
+            'name': lambda : self.name,
+            'description': lambda : self.description,
+            'category': lambda : category_labels[self.category],
+            'image': lambda : self.image,
+            'price': lambda : number(self.whole_price),
+            'soldOut': lambda : self.total_stock == 0,
+            'portions': lambda : [ portion_serializer(portion) for portion in self.portions ],
         }
+
+        return { field: values[field]() for field in fields }
+
+
+category_labels = { category: category.value.lower() for category in Category }
+
+product_serializer = Serializer({
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+    'category': label('category', Category),
+    'image': 'image',
+    'portions': many('portions', portion_serializer),
+})
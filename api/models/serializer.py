@@ -0,0 +1,92 @@
+from operator import attrgetter
+
+
+TIMESTAMP_FORMAT = '%m/%d/%Y %I:%M %p'
+
+
+class Serializer :
+    '''
+    Compiled serializer for a model, converting instances to dictionaries with per-field extractors
+    built once at import rather than on every call.
+
+    Attributes :
+        fields (tuple) : pairs of dictionary key and extractor callable.
+    '''
+
+    def __init__ (self, fields) :
+        '''
+        Initializes a new serializer.
+
+        Args :
+            fields (dict) : maps each dictionary key to an attribute name or to a callable receiving the instance.
+        '''
+        self.fields = tuple(
+            (key, attrgetter(field) if isinstance(field, str) else field) for key, field in fields.items()
+        )
+
+    def __call__ (self, obj) :
+        '''
+        Serializes an instance.
+
+        Args :
+            obj : model instance to serialize.
+
+        Returns :
+            dict : dictionary representation of the instance.
+        '''
+        return { key: extract(obj) for key, extract in self.fields }
+
+
+def label (name, enum) :
+    '''
+    Builds an extractor returning the lowercase value of an enum attribute from a precomputed table.
+    '''
+    labels = { member: member.value.lower() for member in enum }
+    get = attrgetter(name)
+    return lambda obj : labels[get(obj)]
+
+def number (value) :
+    '''
+    Converts a numeric value to a JSON number written the way Postgres writes a float8, whole values as
+    integers (10 rather than 10.0), so payloads built in SQL and in Python are identical.
+    '''
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+def decimal (name) :
+    '''
+    Builds an extractor returning a numeric attribute as a JSON number, see number.
+    '''
+    get = attrgetter(name)
+    return lambda obj : number(get(obj))
+
+def timestamp (name) :
+    '''
+    Builds an extractor returning a datetime attribute formatted with `TIMESTAMP_FORMAT`, or None if unset.
+    '''
+    get = attrgetter(name)
+
+    def extract (obj) :
+        value = get(obj)
+        return None if value is None else value.strftime(TIMESTAMP_FORMAT)
+
+    return extract
+
+def nested (name, serializer) :
+    '''
+    Builds an extractor serializing a related instance, or returning None if unset.
+    '''
+    get = attrgetter(name)
+
+    def extract (obj) :
+        value = get(obj)
+        return None if value is None else serializer(value)
+
+    return extract
+
+def many (name, serializer) :
+    '''
+    Builds an extractor serializing every instance of a collection relationship.
+    '''
+    get = attrgetter(name)
+    return lambda obj : [ serializer(item) for item in get(obj) ]
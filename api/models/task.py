@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from .admin import Admin
+from .serializer import Serializer, timestamp
 
 from ...database import db
 
@@ -88,13 +88,14 @@ class Task (db.Model) :
         Returns :
             dict : dictionary representation of the task, including admin name, order ID. NOTE: camelCasing for ease in frontend.
         '''
-        admin = Admin.query.get(self.admin_id)
-        admin_name = admin.name if admin else None
-    
-        return {
-            'id': self.id,
-            'adminName': admin_name,
-            'orderId': self.order_id,
-            'assignedAt': None if self.assigned_at is None else self.assigned_at.strftime('%m/%d/%Y %I:%M %p'),
-            'completedAt': None if self.completed_at is None else self.completed_at.strftime('%m/%d/%Y %I:%M %p')
-        }
+        return task_serializer(self)
+
+
+task_serializer = Serializer({
+    'id': 'id',
+    # admin is loaded through the relationship, served from the session when already loaded
+    'adminName': lambda task : task.admin.name if task.admin else None,
+    'orderId': 'order_id',
+    'assignedAt': timestamp('assigned_at'),
+    'completedAt': timestamp('completed_at'),
+})
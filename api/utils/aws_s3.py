@@ -2,104 +2,315 @@ import boto3
 from dotenv import load_dotenv
 import os
 import io
+import uuid
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
 
 load_dotenv()
 
-# initialize s3 client with credients from env vars
+# initialize s3 client with credients from env vars, S3_ENDPOINT_URL points it at a local S3 stand-in (e.g. MinIO) if set
 s3 = boto3.client(
     's3',
     aws_access_key_id = os.getenv('AWS_ACCESS_KEY'),
-    aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+    aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY'),
+    endpoint_url = os.getenv('S3_ENDPOINT_URL'),
 )
 
 # defines allowed file extensions for image uploads and maximum file sizes in bytes
 allowed_file_extensions = ['png', 'jpg', 'jpeg', 'gif']
 max_file_size_bytes = 10 * 1024 * 1024
 
+# largest image accepted, in pixels, checked from the header before anything is decoded
+max_image_pixels = 25 * 1000 * 1000
+Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+# renditions generated for every product image as (width, height), each stored in every format below
+image_renditions = {
+    'thumbnail': (100, 100),
+    'card': (250, 250),
+    'detail': (800, 800),
+}
+image_formats = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# content types accepted for direct uploads, by file extension
+upload_content_types = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+}
+
+# seconds a presigned upload stays valid
+upload_url_expiration = 300
+
+# processed images are stored under content addressed keys, so they can be cached for a year
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+# rendition stored as the product's image URL, the WebP and other renditions sit alongside it
+primary_rendition = ('card', 'jpg')
+
+# uploads the renditions of an image concurrently
+upload_pool = ThreadPoolExecutor(max_workers = len(image_renditions) * len(image_formats), thread_name_prefix = 's3-upload')
+
+
+def validate_image_file (file) :
+    '''
+    Checks that an uploaded file has an allowed image extension.
+
+    Args :
+        file (FileStorage) : the uploaded image file.
+
+    Returns :
+        str : the file's extension.
+
+    Raises :
+        ValueError : if the file type is invalid.
+    '''
+    file_type = file.filename.split('.')[-1].lower()
+
+    if file_type not in allowed_file_extensions :
+        raise ValueError('Invalid file type')
+
+    return file_type
+
+
+def read_image_file (file) :
+    '''
+    Reads an uploaded image from the request stream, reading at most one byte past `max_file_size_bytes`
+    so an oversized upload is rejected without being buffered whole.
+
+    Args :
+        file (FileStorage) : the uploaded image file.
+
+    Returns :
+        bytes : the image file.
 
-def compress_and_resize_image (file) :
+    Raises :
+        RequestEntityTooLarge : if the file is larger than `max_file_size_bytes`.
     '''
-    Compresses and resizes an image to 250 x 250 pixels, while converting to JPEG format.
-    If image is a PNG with alpha channel, it is converted to RGB.
+    file = file.stream.read(max_file_size_bytes + 1)
+
+    if len(file) > max_file_size_bytes :
+        raise RequestEntityTooLarge('Image file is too large')
+
+    return file
+
+
+def render_image_renditions (file) :
+    '''
+    Decodes an image once and renders every rendition in every format.
+    Images with an alpha channel or a palette (PNG, GIF) are converted to RGB.
+
+    Images over `max_image_pixels` are rejected from their header. JPEGs are decoded at the smallest
+    scale still covering the largest rendition with draft(), and other images are reduce()d by an integer
+    factor before resizing, so memory follows the rendition sizes rather than the upload's dimensions.
 
     Args :
         file (bytes) : image file to be processed.
 
     Returns :
-        BytesIO : processed image as an in-memory byte stream.
-    
-        
+        dict : processed images as in-memory byte streams, keyed by (rendition name, extension).
+
     Raises :
         ValueError : if there is an error during image processing.
     '''
     try :
-        
+        # opening only parses the header, nothing is decoded yet
         image = Image.open(io.BytesIO(file))
 
-        # for png file uploads, convert to RGB
-        if image.mode == 'RGBA' :
+        if image.width * image.height > max_image_pixels :
+            raise ValueError('Image dimensions are too large')
+
+        largest = max(image_renditions.values())
+        image.draft('RGB', largest)
+
+        if image.mode != 'RGB' :
             image = image.convert('RGB')
 
-        resized_image = image.resize((250, 250))
+        factor = min(image.width // largest[0], image.height // largest[1])
+        if factor > 1 :
+            image = image.reduce(factor)
 
-        # create in-memory byte stream to save processed image
-        output = io.BytesIO()
-        resized_image.save(output, format ='JPEG')
+        renditions = {}
 
-        # reset stream position to start
-        output.seek(0)
+        for name, size in image_renditions.items() :
+            resized_image = image.resize(size)
 
-        return output
+            for extension, (image_format, content_type) in image_formats.items() :
+                # create in-memory byte stream to save processed image
+                output = io.BytesIO()
+                resized_image.save(output, format = image_format)
+
+                # reset stream position to start
+                output.seek(0)
+
+                renditions[(name, extension)] = output
+
+        return renditions
 
     except Exception as error :
         raise ValueError(f'Error compressing and resizing image: {str(error)}')
 
 
-def s3_photo_upload (file, product_id) :
+def s3_image_url (key) :
+    '''
+    Returns the public URL of an object in the S3 bucket.
     '''
-    Uploads a photo to S# bucket.
+    if os.getenv('S3_ENDPOINT_URL') :
+        return '{}/{}/{}'.format(os.getenv('S3_ENDPOINT_URL').rstrip('/'), os.getenv('S3_BUCKET_NAME'), key)
 
-    Checks file extension, uses compress and resize helper, then uploads to S3 bucket
-    under name based on product ID.
+    return 'https://{}.s3.amazonaws.com/{}'.format(os.getenv('S3_BUCKET_NAME'), key)
+
+
+def upload_key_prefix (product_id) :
+    '''
+    Returns the prefix direct uploads for a product are stored under.
+    '''
+    return f'uploads/products/{product_id}/'
+
+
+def presign_image_upload (product_id, file_name) :
+    '''
+    Issues a presigned POST that lets the client upload a product photo straight to the S3 bucket.
+    S3 enforces the content type and the `max_file_size_bytes` limit, so image bytes never pass through the app.
 
     Args :
-        file (FileStorage) : the image file to be uploaded.
-        product_id (str) : ID of product to associate with uploaded image.
+        product_id (int) : ID of product the photo is uploaded for.
+        file_name (str) : name of the file to upload, used for its extension.
 
     Returns :
-        str : the URL of the uploaded image in S3 bucket
+        dict : 'url' and form 'fields' to post the file with, and the 'key' the file is stored under.
 
     Raises :
-        ValueError : if the file type is invalid or if there is an error during upload.
+        ValueError : if the file type is invalid or the upload could not be presigned.
     '''
-
-    # extract file extension and check if allowed
-    file_type = file.filename.split('.')[-1].lower()
+    file_type = file_name.split('.')[-1].lower()
 
     if file_type not in allowed_file_extensions :
         raise ValueError('Invalid file type')
-    
-    # generate file name based on product ID
-    file_name = f'products/{product_id}.{file_type}'
-
-    # compress and resize image
-    resized_file = compress_and_resize_image(file.read())
-
-    if resized_file :
-        try :
-            # upload processed image to S3 bucket
-            s3.upload_fileobj(
-                resized_file,
-                os.getenv('S3_BUCKET_NAME'),
-                file_name,
-            )
-
-            # return image's S3 bucket URL
-            return 'https://{}.s3.amazonaws.com/{}'.format(os.getenv('S3_BUCKET_NAME'), file_name)
-
-        except Exception as error :
-            raise ValueError(f'Error uploading image to S3: {str(error)}')
-    else :
-        return None
\ No newline at end of file
+
+    key = f'{upload_key_prefix(product_id)}{uuid.uuid4().hex}.{file_type}'
+    content_type = upload_content_types[file_type]
+
+    try :
+        upload = s3.generate_presigned_post(
+            os.getenv('S3_BUCKET_NAME'),
+            key,
+            Fields = { 'Content-Type': content_type },
+            Conditions = [
+                { 'Content-Type': content_type },
+                ['content-length-range', 1, max_file_size_bytes],
+            ],
+            ExpiresIn = upload_url_expiration,
+        )
+
+    except Exception as error :
+        raise ValueError(f'Error presigning upload: {str(error)}')
+
+    return { 'url': upload['url'], 'fields': upload['fields'], 'key': key }
+
+
+def read_uploaded_image (key) :
+    '''
+    Reads a directly uploaded photo from the S3 bucket and removes the upload.
+
+    Args :
+        key (str) : key the photo was uploaded under.
+
+    Returns :
+        bytes : the image file.
+
+    Raises :
+        ValueError : if the upload is missing or too large.
+    '''
+    try :
+        uploaded = s3.get_object(Bucket = os.getenv('S3_BUCKET_NAME'), Key = key)
+
+    except Exception as error :
+        raise ValueError(f'Error reading upload from S3: {str(error)}')
+
+    if uploaded['ContentLength'] > max_file_size_bytes :
+        uploaded['Body'].close()
+        raise ValueError('Image file is too large')
+
+    file = uploaded['Body'].read()
+
+    s3.delete_object(Bucket = os.getenv('S3_BUCKET_NAME'), Key = key)
+
+    return file
+
+
+def s3_object_exists (key) :
+    '''
+    Checks that an object exists in the S3 bucket.
+    '''
+    try :
+        s3.head_object(Bucket = os.getenv('S3_BUCKET_NAME'), Key = key)
+        return True
+
+    except Exception :
+        return False
+
+
+def s3_photo_upload (file) :
+    '''
+    Renders every rendition of a product photo and uploads them concurrently to the S3 bucket under
+    images/{digest}/{rendition}.{extension}, where digest is a hash of the processed renditions.
+
+    Keys are content addressed, so an image that was already processed is not uploaded again, and
+    every object is stored with an immutable one year Cache-Control since its URL never changes content.
+
+    Args :
+        file (bytes) : the image file to be uploaded.
+
+    Returns :
+        str : the URL of the primary rendition in S3 bucket.
+
+    Raises :
+        ValueError : if there is an error during processing or upload.
+    '''
+    renditions = render_image_renditions(file)
+
+    digest = hashlib.sha256()
+    for key in sorted(renditions) :
+        digest.update(renditions[key].getbuffer())
+
+    prefix = f'images/{digest.hexdigest()[:32]}'
+
+    name, extension = primary_rendition
+    primary_key = f'{prefix}/{name}.{extension}'
+
+    # the primary rendition is uploaded last, so its presence means the whole set is stored
+    if s3_object_exists(primary_key) :
+        return s3_image_url(primary_key)
+
+    def upload (output, key, extension) :
+        s3.upload_fileobj(
+            output,
+            os.getenv('S3_BUCKET_NAME'),
+            key,
+            ExtraArgs = { 'ContentType': image_formats[extension][1], 'CacheControl': immutable_cache_control },
+        )
+
+    try :
+        uploads = [
+            upload_pool.submit(upload, output, f'{prefix}/{name}.{extension}', extension)
+            for (name, extension), output in renditions.items() if (name, extension) != primary_rendition
+        ]
+
+        for pending in uploads :
+            pending.result()
+
+        upload(renditions[primary_rendition], primary_key, extension)
+
+    except Exception as error :
+        raise ValueError(f'Error uploading image to S3: {str(error)}')
+
+    return s3_image_url(primary_key)
@@ -0,0 +1,114 @@
+from flask import current_app
+from sqlalchemy import event, inspect, select
+
+from ...database import db
+from ..models import Product, Portion, Category
+from .redis_service import invalidate_products
+
+# attributes that decide which page of the listing a product lands on
+listing_attributes = {
+    Product: ['name', 'category'],
+    Portion: ['stock', 'price'],
+}
+
+def register_cache_invalidation (session) :
+    '''
+    Hooks product cache invalidation into the session lifecycle.
+
+    Changed products are collected on every flush and purged from cache once per commit,
+    changes discarded by a rollback are dropped without touching the cache.
+
+    Args :
+        session (scoped_session) : session to listen on.
+    '''
+    event.listen(session, 'after_flush', collect_changed_products)
+    event.listen(session, 'after_commit', invalidate_changed_products)
+    event.listen(session, 'after_rollback', discard_changed_products)
+
+def mark_products_changed (session, product_ids, categories = None) :
+    '''
+    Records products as changed for the current transaction, for writes that bypass the ORM unit of work.
+
+    Args :
+        session (Session) : session the changes were made in.
+        product_ids (iterable) : ids of the products that changed.
+        categories (iterable) : categories whose listings the change can reorder, if any.
+    '''
+    session.info.setdefault('changed_products', set()).update(product_ids)
+
+    if categories :
+        session.info.setdefault('changed_categories', set()).update(categories)
+
+def product_categories (obj) :
+    '''
+    Returns the categories a changed product or portion is listed under, before and after the change.
+    Falls back to every category when the product cannot be resolved.
+    '''
+    product = obj if isinstance(obj, Product) else obj.product
+
+    if product is None :
+        return { category.value for category in Category }
+
+    history = inspect(product).attrs['category'].history
+    categories = [ *history.added, *history.unchanged, *history.deleted ]
+
+    # category may have been assigned as an enum or by name
+    return { getattr(category, 'value', category) for category in categories if category is not None }
+
+def collect_changed_products (session, flush_context) :
+    '''
+    Collects the ids of products affected by the flush, directly or through their portions.
+    '''
+    product_ids = set()
+    categories = set()
+
+    for state, objects in [('new', session.new), ('dirty', session.dirty), ('deleted', session.deleted)] :
+        for obj in objects :
+            if not isinstance(obj, (Product, Portion)) :
+                continue
+
+            if state == 'dirty' and not session.is_modified(obj) :
+                continue
+
+            product_ids.add(obj.id if isinstance(obj, Product) else obj.product_id)
+
+            attributes = inspect(obj).attrs
+            if state != 'dirty' or any(attributes[name].history.has_changes() for name in listing_attributes[type(obj)]) :
+                categories.update(product_categories(obj))
+
+    product_ids.discard(None)
+
+    if product_ids :
+        mark_products_changed(session, product_ids, categories)
+
+def invalidate_changed_products (session) :
+    '''
+    Purges products changed during the committed transaction from cache in one batch, and moves them
+    to their new positions in the catalog listing indexes.
+    '''
+    product_ids = session.info.pop('changed_products', None)
+    categories = session.info.pop('changed_categories', None)
+
+    if not product_ids :
+        return
+
+    try :
+        # the session cannot emit SQL after commit, read the reindexed columns on a separate connection
+        with db.engine.connect() as connection :
+            index_rows = connection.execute(
+                select(Product.id, Product.name, Product.category, Product.total_stock, Product.whole_price)
+                    .where(Product.id.in_(product_ids))
+            ).all()
+
+        invalidate_products(product_ids, categories, index_rows)
+
+    except Exception as error :
+        # the commit already succeeded, stale entries will age out with their TTL
+        current_app.logger.error(f'Error invalidating product cache: {str(error)}')
+
+def discard_changed_products (session) :
+    '''
+    Drops changes collected for a transaction that was rolled back.
+    '''
+    session.info.pop('changed_products', None)
+    session.info.pop('changed_categories', None)
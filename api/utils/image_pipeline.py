@@ -0,0 +1,68 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+from ...database import db
+from ..models import Product
+from .aws_s3 import s3_photo_upload, read_uploaded_image
+
+# processes product images off the request, sized by IMAGE_WORKERS
+image_pool = ThreadPoolExecutor(max_workers = int(os.getenv('IMAGE_WORKERS', 2)), thread_name_prefix = 'image')
+
+
+def enqueue_product_image (file, product_id) :
+    '''
+    Hands a product photo to the background image pool, which renders and uploads its renditions
+    and then points the product's image at them. The request does not wait for processing.
+
+    Args :
+        file (bytes) : the image file, already validated and size checked.
+        product_id (int) : ID of the product the image belongs to.
+
+    Returns :
+        Future : the pending processing job.
+    '''
+    app = current_app._get_current_object()
+    return image_pool.submit(process_product_image, app, lambda : file, product_id)
+
+
+def enqueue_uploaded_product_image (key, product_id) :
+    '''
+    Hands a photo uploaded directly to the S3 bucket to the background image pool, which reads it from S3,
+    renders and uploads its renditions and then points the product's image at them.
+
+    Args :
+        key (str) : key the photo was uploaded under.
+        product_id (int) : ID of the product the image belongs to.
+
+    Returns :
+        Future : the pending processing job.
+    '''
+    app = current_app._get_current_object()
+    return image_pool.submit(process_product_image, app, lambda : read_uploaded_image(key), product_id)
+
+
+def process_product_image (app, read_file, product_id) :
+    '''
+    Renders and uploads a product photo, then updates the product's image in its own transaction.
+    Failures are logged, leaving the product's previous image in place.
+
+    Args :
+        app (Flask) : application to run the job in.
+        read_file (callable) : returns the image file as bytes.
+        product_id (int) : ID of the product the image belongs to.
+    '''
+    with app.app_context() :
+        try :
+            image_url = s3_photo_upload(read_file())
+
+            product = Product.query.get(product_id)
+
+            if product :
+                product.update_attributes({ 'image': image_url })
+                db.session.commit()
+
+        except Exception as error :
+            db.session.rollback()
+            app.logger.error(f'Error processing image for product {product_id}: {str(error)}')
@@ -0,0 +1,67 @@
+from decimal import Decimal
+
+import orjson
+from flask import current_app
+from flask.json.provider import JSONProvider
+
+
+def _default (obj) :
+    '''
+    Serializes types orjson does not handle natively. Datetimes, dates, enums and UUIDs are handled by orjson itself.
+    Decimals are encoded as strings, as Flask's default provider did, so values such as an order's totalPrice keep their format.
+    '''
+    if isinstance(obj, Decimal) :
+        return str(obj)
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps (obj) :
+    '''
+    Serializes an object to JSON bytes.
+
+    Args :
+        obj : object to serialize, may contain Decimals, datetimes and enums.
+
+    Returns :
+        bytes : UTF-8 encoded JSON.
+    '''
+    return orjson.dumps(obj, default = _default, option = orjson.OPT_NON_STR_KEYS)
+
+def loads (data) :
+    '''
+    Deserializes JSON from bytes or a string.
+    '''
+    return orjson.loads(data)
+
+
+class OrjsonProvider (JSONProvider) :
+    '''
+    Flask JSON provider backed by orjson, used by `jsonify` and `request.get_json` across every blueprint.
+    '''
+
+    def dumps (self, obj, **kwargs) :
+        return dumps(obj).decode()
+
+    def loads (self, s, **kwargs) :
+        return loads(s)
+
+    def response (self, *args, **kwargs) :
+        # hand the encoded bytes to the response directly instead of round tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype = 'application/json')
+
+
+def raw_json_response (key, raw, status = 200) :
+    '''
+    Builds a JSON response wrapping an already serialized payload under a single key, so cached JSON
+    can be served without being decoded and encoded again.
+
+    Args :
+        key (str) : top level key of the response object.
+        raw (bytes) : serialized JSON value.
+        status (int) : HTTP status code.
+
+    Returns :
+        Response : JSON response of the form { key: value }.
+    '''
+    return current_app.response_class(b'{' + dumps(key) + b':' + raw + b'}', status = status, mimetype = 'application/json')
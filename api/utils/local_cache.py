@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache :
+    '''
+    Size-bounded, in-process LRU cache with a TTL, used as a per-worker layer in front of Redis.
+
+    Entries are shared between requests and must be treated as read-only by callers.
+
+    Attributes :
+        max_size (int) : maximum number of entries, least recently used entries are evicted first.
+        ttl (int) : seconds an entry is served before it is considered expired.
+    '''
+
+    def __init__ (self, max_size, ttl) :
+        '''
+        Initializes a new local cache instance.
+
+        Args :
+            max_size (int) : maximum number of entries.
+            ttl (int) : seconds an entry is served.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get (self, key) :
+        '''
+        Retrieves an entry, marking it as recently used.
+
+        Returns :
+            any : cached value, or None if missing or expired.
+        '''
+        with self._lock :
+            entry = self._entries.get(key)
+
+            if entry is None :
+                return None
+
+            expires_at, value = entry
+
+            if expires_at < time.monotonic() :
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set (self, key, value) :
+        '''
+        Stores an entry, evicting the least recently used entries when full.
+        '''
+        with self._lock :
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size :
+                self._entries.popitem(last = False)
+
+    def delete (self, *keys) :
+        '''
+        Removes the given entries if present.
+        '''
+        with self._lock :
+            for key in keys :
+                self._entries.pop(key, None)
+
+    def clear (self) :
+        '''
+        Removes every entry.
+        '''
+        with self._lock :
+            self._entries.clear()
+
+
+# decoded product dictionaries and their serialized JSON keyed by product id, and product listing payloads keyed by page cache key
+product_cache = LocalCache(max_size = 1024, ttl = 30)
+product_json_cache = LocalCache(max_size = 1024, ttl = 30)
+page_cache = LocalCache(max_size = 256, ttl = 30)
@@ -1,115 +1,752 @@
 import os
-import json
+import hashlib
+import random
+import time
+import uuid
 
 from cryptography.fernet import Fernet
+from redis.exceptions import WatchError
 from ...redis_config import get_redis_client
+from .local_cache import product_cache, product_json_cache, page_cache
+from .json_provider import dumps, loads
+from ..models import Category
 
 fernet = Fernet(os.getenv('FERNET_KEY').encode())
 
-def need_product_cache_bucket () :
+# pointer to the live catalog generation, swapped atomically on every rebuild
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_GENERATION_KEY = 'catalog:generation'
+
+# seconds a catalog generation is served, and how long a replaced generation lingers for in-flight readers
+CATALOG_TTL = 3600
+CATALOG_GRACE_PERIOD = 60
+
+# fraction by which a generation's lifetime is randomized, and fraction of it after which a rebuild starts
+CATALOG_TTL_JITTER = 0.1
+CATALOG_REFRESH_AHEAD = 0.8
+
+# refresh deadline of the live generation, and the lock held by the single worker rebuilding it
+CATALOG_REFRESH_AT_KEY = 'catalog:refresh_at'
+CATALOG_REBUILD_LOCK_KEY = 'catalog:rebuild:lock'
+CATALOG_REBUILD_LOCK_TIMEOUT = 30
+CATALOG_REBUILD_ATTEMPTS = 3
+
+# channel on which product changes are broadcast to every worker's local caches
+CACHE_INVALIDATION_CHANNEL = 'catalog:invalidate'
+
+# revision counters used to derive ETags, bumped on every change, and a random epoch distinguishing
+# revisions issued before and after a Redis flush
+CATALOG_EPOCH_KEY = 'catalog:epoch'
+CATALOG_REVISION_KEY = 'catalog:revision'
+PRODUCT_REVISIONS_KEY = 'catalog:revisions'
+
+# sorted set indexes of the listing orders, kept per generation for every product and for each category
+CATALOG_INDEX_SCOPES = ['ALL', *[ category.value for category in Category ]]
+
+# listing order of each sorting option, as (index, reversed)
+CATALOG_INDEX_ORDERS = {
+    'priceAsc': ('price', False),
+    'priceDesc': ('price', True),
+    'nameAsc': ('name', False),
+    'nameDesc': ('name', True),
+}
+
+# scores embed the product id as a tie breaker, which assumes ids below this bound
+CATALOG_INDEX_ID_SPACE = 10 ** 8
+
+# sets a TTL on the keys that have none, like EXPIRE ... NX which needs Redis 7
+# KEYS : keys to expire
+# ARGV : seconds to live
+EXPIRE_IF_PERSISTENT_SCRIPT = '''
+for _, key in ipairs(KEYS) do
+    if redis.call('TTL', key) == -1 then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+end
+return 0
+'''
+
+# writes products into a catalog generation unless they changed since they were read
+# KEYS : version pointer, product revisions, products of the generation
+# ARGV : version of the generation, then product id, revision read before loading ('' if none), product JSON triples
+CACHE_PRODUCT_ENTRIES_SCRIPT = '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return {}
+end
+
+local written = {}
+for i = 2, #ARGV, 3 do
+    if (redis.call('HGET', KEYS[2], ARGV[i]) or '') == ARGV[i + 1] then
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 2])
+        table.insert(written, ARGV[i])
+    end
+end
+return written
+'''
+
+def _catalog_products_key (version) :
+    return f'catalog:{version}:products'
+
+def _catalog_index_key (version, *parts) :
+    return f'catalog:{version}:index:' + ':'.join(parts)
+
+def _catalog_index_keys (version) :
+    keys = [ _catalog_index_key(version, 'names') ]
+
+    for scope in CATALOG_INDEX_SCOPES :
+        keys.append(_catalog_index_key(version, scope, 'stock'))
+        for order in ['price', 'name'] :
+            keys.extend(_catalog_index_key(version, scope, order, stock) for stock in ['in', 'out'])
+
+    return keys
+
+def _index_product (pipe, version, product) :
     '''
-    Checks if any keys with 'all_products' exists in cache using scan.
-    Indicates whether a new cache of all the products needs to be created.
+    Queues the index entries of a product.
+
+    The stock index scores by total stock then id, read in reverse for the recommended order. The price and name
+    indexes are split into in stock and sold out sets, which are read in turn so sold out products come last.
+    Price scores combine whole price in cents with the id, name members share a score and sort by the lowercased
+    name followed by the zero padded id.
+
+    Args :
+        pipe (Pipeline) : pipeline to queue commands on.
+        version (str) : catalog generation to index into.
+        product (Product or Row) : product with id, name, category, total_stock and whole_price.
+    '''
+    category = getattr(product.category, 'value', product.category)
+    stock = 'in' if product.total_stock > 0 else 'out'
+    name_member = f'{product.name.lower()}\x00{product.id:010d}'
+
+    for scope in ['ALL', category] :
+        pipe.zadd(_catalog_index_key(version, scope, 'stock'), {
+            product.id: product.total_stock * CATALOG_INDEX_ID_SPACE + (CATALOG_INDEX_ID_SPACE - product.id)
+        })
+        pipe.zadd(_catalog_index_key(version, scope, 'price', stock), {
+            product.id: int(product.whole_price * 100) * CATALOG_INDEX_ID_SPACE + product.id
+        })
+        pipe.zadd(_catalog_index_key(version, scope, 'name', stock), { name_member: 0 })
+
+    pipe.hset(_catalog_index_key(version, 'names'), product.id, name_member)
+
+def _unindex_product (pipe, version, id, name_member) :
+    '''
+    Queues the removal of a product from every index of a generation.
+    '''
+    for scope in CATALOG_INDEX_SCOPES :
+        pipe.zrem(_catalog_index_key(version, scope, 'stock'), id)
+
+        for stock in ['in', 'out'] :
+            pipe.zrem(_catalog_index_key(version, scope, 'price', stock), id)
+            if name_member :
+                pipe.zrem(_catalog_index_key(version, scope, 'name', stock), name_member)
+
+    pipe.hdel(_catalog_index_key(version, 'names'), id)
+
+def ensure_catalog_cache (load_products) :
+    '''
+    Makes sure a catalog generation is cached, rebuilding it with single-flight protection.
+
+    The version pointer and refresh deadline are read in one round trip. Once the deadline passes, which is
+    before the generation expires, one worker takes the rebuild lock and rebuilds while every other worker
+    keeps serving the current generation. Workers that find no generation and lose the lock do not wait,
+    product lookups fall back to the database until the rebuild is published. A rebuild that overlapped
+    an invalidation is discarded and loaded again, up to `CATALOG_REBUILD_ATTEMPTS` times.
+
+    Args :
+        load_products (callable) : returns the list of product objects to cache, only called by the lock holder.
 
     Returns :
-        bool : True is no 'all_products*' keys are found, False otherwise.
+        bool : True if this call rebuilt the catalog, False otherwise.
     '''
     redis_client = get_redis_client()
 
-    while True :
-        cursor, keys = redis_client.scan(cursor = 0, match = 'all_products*', count = 100)
+    with redis_client.pipeline(transaction = False) as pipe :
+        pipe.get(CATALOG_VERSION_KEY)
+        pipe.get(CATALOG_REFRESH_AT_KEY)
 
-        # indicates that a key was found
-        if keys :
-            return False
-        
-        # indicates scan is finished
-        if cursor == 0 :
-            break
+        version, refresh_at = pipe.execute()
+
+    if version is not None and refresh_at is not None and float(refresh_at) > time.time() :
+        return False
+
+    token = uuid.uuid4().hex
+
+    if not redis_client.set(CATALOG_REBUILD_LOCK_KEY, token, nx = True, ex = CATALOG_REBUILD_LOCK_TIMEOUT) :
+        return False
+
+    try :
+        for attempt in range(CATALOG_REBUILD_ATTEMPTS) :
+            # changes invalidated while loading would be missing from the new generation, so it is only
+            # published if the catalog revision did not move in the meantime, otherwise it is loaded again
+            revision = redis_client.get(CATALOG_REVISION_KEY) or ''
+
+            if cache_products(load_products(), revision) :
+                break
+
+    finally :
+        # only release the lock if it was not taken over after expiring
+        redis_client.eval(
+            "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0",
+            1, CATALOG_REBUILD_LOCK_KEY, token
+        )
 
     return True
 
-def cache_products (products) :
+def cache_products (products, revision = None) :
     '''
-    Caches a list of products, storing each product as a JSON string with the key format of 'all_products:product.id'.
-    Sets the expiration for each cache entry to 1 hour.
+    Caches a list of products as a new catalog generation.
+
+    Every product is stored as a JSON string in a single hash under the new generation, keyed by product id,
+    and added to the generation's listing indexes. The hash, indexes and the version pointer are written in
+    one transaction, so readers either see the previous generation or the complete new one, never a partial
+    catalog. The replaced generation is kept briefly for readers that already resolved the old pointer.
+
+    The generation's lifetime is jittered, and a refresh deadline ahead of its expiry is stored for
+    ensure_catalog_cache.
 
     Args :
         products (list) : list of product objects from database to be cached.
+        revision (str) : catalog revision read before the products were loaded. If given, the generation is only
+            published while the revision is unchanged, since any invalidation in between would be lost.
+
+    Returns :
+        bool : True if the generation was published, False if the revision moved.
     '''
     redis_client = get_redis_client()
-    
+    products = list(products)
+
+    version = redis_client.incr(CATALOG_GENERATION_KEY)
+    previous_version = redis_client.get(CATALOG_VERSION_KEY)
+
+    # jitter the lifetime so generations written together do not expire together
+    ttl = int(CATALOG_TTL * random.uniform(1 - CATALOG_TTL_JITTER, 1 + CATALOG_TTL_JITTER))
+    refresh_at = time.time() + ttl * CATALOG_REFRESH_AHEAD
+
+    products_key = _catalog_products_key(version)
+    entries = { product.id: dumps(product.as_dict()) for product in products }
+
     with redis_client.pipeline() as pipe :
+        if revision is not None :
+            # publishing fails with a WatchError if an invalidation bumps the revision before it executes
+            pipe.watch(CATALOG_REVISION_KEY)
+
+            if (pipe.get(CATALOG_REVISION_KEY) or '') != revision :
+                return False
+
+            pipe.multi()
+
+        if entries :
+            pipe.hset(products_key, mapping = entries)
+            pipe.expire(products_key, ttl + CATALOG_GRACE_PERIOD)
+
         for product in products :
-            pipe.set(f'all_products:{product.id}', json.dumps(product.as_dict()), ex = 3600)
+            _index_product(pipe, version, product)
 
-        pipe.execute()
+        for key in _catalog_index_keys(version) :
+            pipe.expire(key, ttl + CATALOG_GRACE_PERIOD)
+
+        pipe.set(CATALOG_VERSION_KEY, version, ex = ttl)
+        pipe.set(CATALOG_REFRESH_AT_KEY, refresh_at, ex = ttl)
+
+        if previous_version :
+            for key in [ _catalog_products_key(previous_version), *_catalog_index_keys(previous_version) ] :
+                pipe.expire(key, CATALOG_GRACE_PERIOD)
+
+        pipe.set(CATALOG_EPOCH_KEY, uuid.uuid4().hex[:8], nx = True)
+        pipe.incr(CATALOG_REVISION_KEY)
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, dumps({ 'all': True }))
+
+        try :
+            pipe.execute()
+        except WatchError :
+            return False
+
+    clear_local_caches()
+
+    return True
 
 def get_product_cache (id) :
+    '''
+    Retrieves a single product from the worker's local cache, or from the live catalog generation.
+
+    Args :
+        id (int) : id of the product to retrieve.
+
+    Returns :
+        dict : product dictionary.
+        None : if no catalog generation is cached or the product is not in it.
+    '''
+    product = product_cache.get(id)
+    if product is not None :
+        return product
+
     redis_client = get_redis_client()
-    product = redis_client.get(f'all_products:{id}')
 
-    return json.loads(product) if product else None
+    version = redis_client.get(CATALOG_VERSION_KEY)
+    if version is None :
+        return None
+
+    product = redis_client.hget(_catalog_products_key(version), id)
+
+    if product :
+        product = loads(product)
+        product_cache.set(id, product)
+        return product
+
+    return None
+
+def get_product_cache_raw (id) :
+    '''
+    Retrieves a product's serialized JSON from the worker's local cache or the live catalog generation,
+    without decoding it, so it can be passed through to a response as is.
+
+    Args :
+        id (int) : id of the product to retrieve.
+
+    Returns :
+        bytes : serialized product dictionary.
+        None : if no catalog generation is cached or the product is not in it.
+    '''
+    product = product_json_cache.get(id)
+    if product is not None :
+        return product
+
+    redis_client = get_redis_client()
+
+    version = redis_client.get(CATALOG_VERSION_KEY)
+    if version is None :
+        return None
+
+    product = redis_client.hget(_catalog_products_key(version), id)
+
+    if product :
+        product = product.encode()
+        product_json_cache.set(id, product)
+        return product
+
+    return None
+
+def get_products_cache (ids, version = None) :
+    '''
+    Retrieves many products from the worker's local cache, fetching the rest from the live catalog
+    generation with a single HMGET.
+
+    Args :
+        ids (list) : ids of the products to retrieve.
+        version (str) : catalog version to read from, resolved from the version pointer if not provided.
+
+    Returns :
+        tuple : dictionary of cached products keyed by id, and list of ids that were not found in cache.
+    '''
+    products = {}
+    remote_ids = []
+
+    for id in ids :
+        product = product_cache.get(id)
+        if product is not None :
+            products[id] = product
+        else :
+            remote_ids.append(id)
+
+    if not remote_ids :
+        return products, []
+
+    redis_client = get_redis_client()
+
+    if version is None :
+        version = redis_client.get(CATALOG_VERSION_KEY)
+
+    if version is None :
+        return products, remote_ids
+
+    cached = redis_client.hmget(_catalog_products_key(version), remote_ids)
+
+    missing_ids = []
+
+    for id, product in zip(remote_ids, cached) :
+        if product :
+            products[id] = loads(product)
+            product_cache.set(id, products[id])
+        else :
+            missing_ids.append(id)
+
+    return products, missing_ids
+
+def get_product_revisions (ids) :
+    '''
+    Retrieves the raw revision counters of many products with a single HMGET, read before loading them from the
+    database so that cache_product_entries can tell whether they changed in the meantime.
+
+    Args :
+        ids (list) : ids of the products.
+
+    Returns :
+        dict : revision keyed by product id, None for products that never changed.
+    '''
+    if not ids :
+        return {}
+
+    redis_client = get_redis_client()
+
+    return dict(zip(ids, redis_client.hmget(PRODUCT_REVISIONS_KEY, ids)))
+
+def cache_product_entries (products, revisions) :
+    '''
+    Writes individual product dictionaries into the live catalog generation, used to refill cache misses.
+
+    A product is only written if its revision still matches the one read before it was loaded, checked and written
+    atomically, so a load that raced a commit and its invalidation cannot put the stale row back. Nothing is written
+    if no catalog generation is cached, the next rebuild will include the products.
+
+    Args :
+        products (list) : list of product dictionaries to be cached.
+        revisions (dict) : revisions keyed by product id, see get_product_revisions.
+    '''
+    redis_client = get_redis_client()
+
+    version = redis_client.get(CATALOG_VERSION_KEY)
+
+    if version is None or not products :
+        return
+
+    arguments = [ version ]
+    for product in products :
+        arguments.extend([ product['id'], revisions.get(product['id']) or '', dumps(product) ])
+
+    written = redis_client.eval(
+        CACHE_PRODUCT_ENTRIES_SCRIPT, 3, CATALOG_VERSION_KEY, PRODUCT_REVISIONS_KEY, _catalog_products_key(version), *arguments
+    )
+    written = { int(id) for id in written }
+
+    for product in products :
+        if product['id'] in written :
+            product_cache.set(product['id'], product)
 
 def get_filtered_products_cache (key) :
     '''
     Retrieves a filtered list of products from cache based on provided filter parameters (indicated in key).
-    
-    Gets list of product ids and pagination metadata (needed for the response) from cache using key and retrieves
-    the product data from the 'all_products*' cache.
+
+    Gets the catalog version, list of product ids and pagination metadata (needed for the response) in one
+    pipelined round trip, then retrieves every product body from the catalog generation with a single HMGET.
 
     Args :
         key (str) : cache key for retrieving filtered products, indicates what page, sort and filter.
 
     Returns :
-        dict : dictionary containing list of products and pagination metadata
+        dict : dictionary containing ordered product ids, cached products keyed by id, ids missing from the catalog
+            cache, and pagination metadata. Ids are empty for a cached page with no results.
         None : if no product ids or metadata found in cache from given key.
     '''
     redis_client = get_redis_client()
 
-    product_ids = redis_client.get(key)
-    metadata = redis_client.get(f'{key}:metadata')
+    with redis_client.pipeline(transaction = False) as pipe :
+        pipe.get(CATALOG_VERSION_KEY)
+        pipe.get(key)
+        pipe.get(f'{key}:metadata')
 
-    products = []
+        version, product_ids, metadata = pipe.execute()
 
-    if product_ids and metadata :
-        for id in json.loads(product_ids) :
-            product = redis_client.get(f'product:{id}')
-            if product :
-                products.append(json.loads(product))
-        
-        return {
-            'products': products,
-            'totalPages': json.loads(metadata).get('totalPages'),
-            'currentPage': json.loads(metadata).get('currentPage')
-        } if products else None
-    
-    return None
+    if product_ids is None or metadata is None :
+        return None
+
+    product_ids = loads(product_ids)
+    metadata = loads(metadata)
+
+    products, missing_ids = get_products_cache(product_ids, version)
 
-def cache_filtered_products (key, response) :
+    return {
+        'ids': product_ids,
+        'products': products,
+        'missingIds': missing_ids,
+        'totalPages': metadata.get('totalPages'),
+        'currentPage': metadata.get('currentPage')
+    }
+
+# registry of every cached filtered page key scored by expiry, capped at FILTERED_PAGES_MAX entries
+FILTERED_PAGES_KEY = 'filter:products:pages'
+FILTERED_PAGES_MAX = 5000
+
+# seconds a filtered page is cached, and a shorter lifetime for pages with no results
+FILTERED_PAGE_TTL = 300
+FILTERED_PAGE_EMPTY_TTL = 30
+
+def _filtered_pages_tag_key (product_id) :
+    return f'filter:products:tag:{product_id}'
+
+def _filtered_pages_category_key (category) :
+    return f'filter:products:category:{category}'
+
+def filtered_products_cache_key (page, category, search, sort) :
+    '''
+    Builds a normalized cache key for a filtered product page.
+
+    Category and sort are normalized to their canonical values, and the search term is case folded,
+    whitespace collapsed and hashed, so equivalent queries share an entry and key length is bounded.
+
+    Args :
+        page (int) : page number.
+        category (str) : category filter, or None.
+        search (str) : search term, or None.
+        sort (str) : sorting option, or None.
+
+    Returns :
+        str : cache key in the format 'filter:products:{category}:{sort}:{page}:{search digest}'.
+    '''
+    category = category.upper() if category else 'ALL'
+    sort = sort if sort in ['priceAsc', 'priceDesc', 'nameAsc', 'nameDesc'] else 'recommended'
+
+    search = ' '.join(search.lower().split()) if search else ''
+    search_digest = hashlib.sha1(search.encode()).hexdigest()[:16] if search else '-'
+
+    return f'filter:products:{category}:{sort}:{page}:{search_digest}'
+
+def cache_filtered_products (key, product_ids, total_pages, current_page, category = None) :
     '''
     Caches the results of a filtered product query.
 
-    Stores list of product ids and pagination metadata under given key.
+    Stores list of product ids and pagination metadata under given key with a jittered TTL, using a short TTL
+    for pages with no results so that lookups for missing terms are also served from cache. The key is
+    registered, tagged with its category and with each product it contains so that changes can purge it,
+    and the oldest pages are evicted once the registry exceeds FILTERED_PAGES_MAX.
 
     Args :
-        key (str) : cache key for storing filtered products, indicates what page, sort and filter.
-        response (dict) : dictionary containing list of products and pagination metadata.
+        key (str) : cache key for storing filtered products, see filtered_products_cache_key.
+        product_ids (list) : ordered ids of the products on the page.
+        total_pages (int) : total number of pages of the query.
+        current_page (int) : page number.
+        category (str) : category filter of the page, or None if unfiltered.
     '''
     redis_client = get_redis_client()
-    product_ids = [product['id'] for product in response['products']]
     metadata = {
-        'totalPages': response['totalPages'],
-        'currentPage': response['currentPage']
+        'totalPages': total_pages,
+        'currentPage': current_page
     }
 
+    ttl = FILTERED_PAGE_TTL if product_ids else FILTERED_PAGE_EMPTY_TTL
+    ttl = int(ttl * random.uniform(1 - CATALOG_TTL_JITTER, 1 + CATALOG_TTL_JITTER))
+    now = time.time()
+
+    tag_keys = [ _filtered_pages_category_key(category.upper() if category else 'ALL') ]
+    tag_keys.extend(_filtered_pages_tag_key(id) for id in product_ids)
+
     with redis_client.pipeline() as pipe :
-        pipe.set(key, json.dumps(product_ids))
-        pipe.set(f'{key}:metadata', json.dumps(metadata))
+        pipe.set(key, dumps(product_ids), ex = ttl)
+        pipe.set(f'{key}:metadata', dumps(metadata), ex = ttl)
+
+        for tag_key in tag_keys :
+            pipe.sadd(tag_key, key)
+            pipe.expire(tag_key, FILTERED_PAGE_TTL * 2)
+
+        # drop registry entries of pages that already expired, then register this page
+        pipe.zremrangebyscore(FILTERED_PAGES_KEY, '-inf', now)
+        pipe.zadd(FILTERED_PAGES_KEY, { key: now + ttl })
+        pipe.zcard(FILTERED_PAGES_KEY)
+
+        registered = pipe.execute()[-1]
+
+    if registered > FILTERED_PAGES_MAX :
+        evicted = [ evicted_key for evicted_key, score in redis_client.zpopmin(FILTERED_PAGES_KEY, registered - FILTERED_PAGES_MAX) ]
+        redis_client.delete(*evicted, *[ f'{evicted_key}:metadata' for evicted_key in evicted ])
+
+def invalidate_products (product_ids, categories = None, index_rows = None) :
+    '''
+    Removes changed products from the live catalog generation along with every filtered page that contains them,
+    and moves them to their new positions in the generation's listing indexes.
+
+    Resolves the catalog version and affected page keys in one pipelined round trip, then applies every
+    change in a single transaction and notifies every worker to drop its local copies.
+
+    Args :
+        product_ids (iterable) : ids of the products that changed.
+        categories (iterable) : categories whose listings changed, for changes that can move products between
+            pages (products created or deleted, or a change to a sorted or filtered attribute). Every page of
+            those categories and every unfiltered page is purged.
+        index_rows (list) : current id, name, category, total_stock and whole_price of the changed products that
+            still exist, products missing from it are removed from the indexes. Indexes are left as is if None.
+    '''
+    redis_client = get_redis_client()
+    product_ids = list(product_ids)
+    tag_keys = [ _filtered_pages_tag_key(id) for id in product_ids ]
+
+    if categories :
+        tag_keys.extend(_filtered_pages_category_key(category) for category in { *categories, 'ALL' })
+
+    with redis_client.pipeline(transaction = False) as pipe :
+        pipe.get(CATALOG_VERSION_KEY)
+
+        for tag_key in tag_keys :
+            pipe.smembers(tag_key)
+
+        version, *page_key_sets = pipe.execute()
+
+    page_keys = set().union(*page_key_sets)
+
+    # name index members are derived from the previous name, so they are looked up before removal
+    reindex = version is not None and index_rows is not None and product_ids
+    name_members = redis_client.hmget(_catalog_index_key(version, 'names'), product_ids) if reindex else []
+
+    with redis_client.pipeline() as pipe :
+        if version is not None and product_ids :
+            pipe.hdel(_catalog_products_key(version), *product_ids)
+
+        if reindex :
+            for id, name_member in zip(product_ids, name_members) :
+                _unindex_product(pipe, version, id, name_member)
+
+            for row in index_rows :
+                _index_product(pipe, version, row)
+
+            # keys first created by this update still expire with the generation
+            index_keys = _catalog_index_keys(version)
+            pipe.eval(EXPIRE_IF_PERSISTENT_SCRIPT, len(index_keys), *index_keys, CATALOG_TTL + CATALOG_GRACE_PERIOD)
+
+        if page_keys :
+            pipe.delete(*page_keys, *[ f'{key}:metadata' for key in page_keys ])
+            pipe.zrem(FILTERED_PAGES_KEY, *page_keys)
+
+        if tag_keys :
+            pipe.delete(*tag_keys)
+
+        pipe.set(CATALOG_EPOCH_KEY, uuid.uuid4().hex[:8], nx = True)
+        pipe.incr(CATALOG_REVISION_KEY)
+        for id in product_ids :
+            pipe.hincrby(PRODUCT_REVISIONS_KEY, id, 1)
+
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, dumps({ 'products': product_ids }))
 
         pipe.execute()
 
+    clear_local_caches(product_ids)
+
+def get_catalog_revision () :
+    '''
+    Retrieves the catalog revision, which changes whenever any product changes.
+
+    Returns :
+        str : catalog revision, qualified by the catalog epoch.
+    '''
+    redis_client = get_redis_client()
+
+    with redis_client.pipeline(transaction = False) as pipe :
+        pipe.set(CATALOG_EPOCH_KEY, uuid.uuid4().hex[:8], nx = True)
+        pipe.get(CATALOG_EPOCH_KEY)
+        pipe.get(CATALOG_REVISION_KEY)
+
+        created, epoch, revision = pipe.execute()
+
+    return f'{epoch}.{revision or 0}'
+
+def get_product_revision (id) :
+    '''
+    Retrieves the revision of a single product, which changes whenever that product or its portions change.
+
+    Args :
+        id (int) : id of the product.
+
+    Returns :
+        str : product revision, qualified by the catalog epoch.
+    '''
+    redis_client = get_redis_client()
+
+    with redis_client.pipeline(transaction = False) as pipe :
+        pipe.set(CATALOG_EPOCH_KEY, uuid.uuid4().hex[:8], nx = True)
+        pipe.get(CATALOG_EPOCH_KEY)
+        pipe.hget(PRODUCT_REVISIONS_KEY, id)
+
+        created, epoch, revision = pipe.execute()
+
+    return f'{epoch}.{revision or 0}'
+
+def get_indexed_page (scope, sort, page, per_page) :
+    '''
+    Retrieves the product ids of one listing page from the live generation's sorted set indexes, without the database.
+
+    The name index orders by lowercased name bytes, which can differ from the database collation for
+    names outside of plain ASCII letters.
+
+    Args :
+        scope (str) : category to list, or 'ALL'.
+        sort (str) : sorting option ('priceAsc', 'priceDesc', 'nameAsc', 'nameDesc'), anything else is recommended.
+        page (int) : page number.
+        per_page (int) : number of products per page.
+
+    Returns :
+        tuple : ordered product ids of the page, and total number of products in the listing.
+        None : if no catalog generation is cached.
+    '''
+    redis_client = get_redis_client()
+
+    version = redis_client.get(CATALOG_VERSION_KEY)
+    if version is None :
+        return None
+
+    order, reverse = CATALOG_INDEX_ORDERS.get(sort, ('stock', True))
+    start = (page - 1) * per_page
+    end = start + per_page - 1
+
+    if order == 'stock' :
+        key = _catalog_index_key(version, scope, 'stock')
+
+        with redis_client.pipeline(transaction = False) as pipe :
+            pipe.zcard(key)
+            pipe.zrange(key, start, end, desc = True)
+
+            total, members = pipe.execute()
+
+    else :
+        in_key = _catalog_index_key(version, scope, order, 'in')
+        out_key = _catalog_index_key(version, scope, order, 'out')
+
+        with redis_client.pipeline(transaction = False) as pipe :
+            pipe.zcard(in_key)
+            pipe.zcard(out_key)
+            pipe.zrange(in_key, start, end, desc = reverse)
+
+            in_total, out_total, members = pipe.execute()
+
+        # continue into the sold out products once the in stock products run out
+        if len(members) < per_page and end >= in_total and out_total :
+            members += redis_client.zrange(out_key, max(start - in_total, 0), end - in_total, desc = reverse)
+
+        total = in_total + out_total
+
+    return [ int(member.rsplit('\x00', 1)[-1]) for member in members ], total
+
+def clear_local_caches (product_ids = None) :
+    '''
+    Drops entries from this worker's local caches. Cached pages are always cleared since any product change can alter them.
+
+    Args :
+        product_ids (list) : ids of the products to drop, or None to drop every product.
+    '''
+    if product_ids is None :
+        product_cache.clear()
+        product_json_cache.clear()
+    else :
+        product_cache.delete(*product_ids)
+        product_json_cache.delete(*product_ids)
+
+    page_cache.clear()
+
+def _handle_invalidation_message (message) :
+    data = loads(message['data'])
+    clear_local_caches(None if data.get('all') else data.get('products'))
+
+def start_cache_invalidation_listener () :
+    '''
+    Subscribes this worker to the cache invalidation channel in a background thread, keeping its local caches
+    coherent with changes committed by any worker.
+
+    Returns :
+        PubSubWorkerThread : the listening thread.
+    '''
+    redis_client = get_redis_client()
+
+    pubsub = redis_client.pubsub(ignore_subscribe_messages = True)
+    pubsub.subscribe(**{ CACHE_INVALIDATION_CHANNEL: _handle_invalidation_message })
 
+    return pubsub.run_in_thread(sleep_time = 1, daemon = True)
 
 def encrypt_token (token) :
     return fernet.encrypt(token.encode()).decode()
@@ -0,0 +1,216 @@
+import threading
+import time
+import uuid
+
+from ...redis_config import get_redis_client
+
+# every key shares the {stock} hash tag, so the scripts below can declare them all and still run on one Redis Cluster slot
+
+# quantity held per portion across every active hold
+HELD_STOCK_KEY = '{stock}:held'
+
+# hold ids scored by the time they expire, scanned by the sweeper
+HOLD_DEADLINES_KEY = '{stock}:holds:deadlines'
+
+# each hold as JSON keyed by hold id, holding the user it was placed for and its portion id, quantity pairs.
+# holds never expire on their own, so that their quantities are always returned to the pool by a release
+HOLDS_KEY = '{stock}:holds'
+
+# active hold of each user keyed by user id, replaced when the user starts another checkout
+HOLD_USERS_KEY = '{stock}:holds:users'
+
+# most expired holds released per sweep, and seconds between sweeps
+HOLD_SWEEP_BATCH = 500
+HOLD_SWEEP_INTERVAL = 30
+
+# releases a hold : returns its quantities to the pool of available stock and forgets it.
+# safe to run twice for the same hold, the second run finds nothing to release.
+# KEYS : held stock, hold deadlines, holds, user holds
+RELEASE_HOLD_SCRIPT = '''
+local function release (hold_id)
+    local hold = redis.call('HGET', KEYS[3], hold_id)
+    redis.call('ZREM', KEYS[2], hold_id)
+
+    if not hold then
+        return {}
+    end
+
+    hold = cjson.decode(hold)
+    local quantities = hold['quantities']
+
+    for i = 1, #quantities, 2 do
+        if redis.call('HINCRBY', KEYS[1], quantities[i], -tonumber(quantities[i + 1])) <= 0 then
+            redis.call('HDEL', KEYS[1], quantities[i])
+        end
+    end
+
+    redis.call('HDEL', KEYS[3], hold_id)
+
+    if hold['user'] ~= '' and redis.call('HGET', KEYS[4], hold['user']) == hold_id then
+        redis.call('HDEL', KEYS[4], hold['user'])
+    end
+
+    return quantities
+end
+'''
+
+# KEYS : held stock, hold deadlines, holds, user holds
+# ARGV : hold id, expiry timestamp, current timestamp, user id ('' if none), then portion id, quantity, stock triples
+# releases the user's previous hold, then holds every portion if stock minus held quantity covers it,
+# otherwise holds nothing and returns the short portion ids
+PLACE_HOLD_SCRIPT = RELEASE_HOLD_SCRIPT + '''
+-- free stock held by expired holds first, so availability does not wait for the sweeper
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[3], 'LIMIT', 0, 100)
+for _, hold_id in ipairs(expired) do
+    release(hold_id)
+end
+
+-- a new checkout replaces the user's previous one, whose units are available to it again
+if ARGV[4] ~= '' then
+    local previous = redis.call('HGET', KEYS[4], ARGV[4])
+    if previous then
+        release(previous)
+    end
+end
+
+local short = {}
+for i = 5, #ARGV, 3 do
+    local held = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+    if tonumber(ARGV[i + 2]) - held < tonumber(ARGV[i + 1]) then
+        table.insert(short, ARGV[i])
+    end
+end
+
+if #short > 0 then
+    return short
+end
+
+local quantities = {}
+for i = 5, #ARGV, 3 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    table.insert(quantities, ARGV[i])
+    table.insert(quantities, ARGV[i + 1])
+end
+
+redis.call('HSET', KEYS[3], ARGV[1], cjson.encode({ user = ARGV[4], quantities = quantities }))
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[4], ARGV[4], ARGV[1])
+end
+
+return short
+'''
+
+# KEYS : held stock, hold deadlines, holds, user holds
+# ARGV : hold id
+RELEASE_SCRIPT = RELEASE_HOLD_SCRIPT + '''
+return release(ARGV[1])
+'''
+
+# KEYS : held stock, hold deadlines, holds, user holds
+# ARGV : current timestamp, batch size
+SWEEP_SCRIPT = RELEASE_HOLD_SCRIPT + '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, hold_id in ipairs(expired) do
+    release(hold_id)
+end
+return #expired
+'''
+
+# keys every script above is run with
+HOLD_KEYS = [ HELD_STOCK_KEY, HOLD_DEADLINES_KEY, HOLDS_KEY, HOLD_USERS_KEY ]
+
+
+def place_stock_hold (quantities, stock, ttl, user_id = None) :
+    '''
+    Holds stock for a checkout, so it is not sold to anyone else while the customer pays.
+
+    Available stock is a portion's stock minus the quantity held by every active hold. The check and
+    the hold happen atomically in Redis, so concurrent checkouts cannot hold the same units. A user holds
+    stock for one checkout at a time, their previous hold is released first, even if the new one is short.
+
+    Args :
+        quantities (dict) : quantity to hold keyed by portion ID.
+        stock (dict) : current stock keyed by portion ID.
+        ttl (int) : seconds until the hold expires and is released by the sweeper.
+        user_id (int) : ID of the user checking out, or None if the hold belongs to no user.
+
+    Returns :
+        tuple : ID of the hold, or None if nothing was held, and list of IDs of the portions without enough available stock.
+    '''
+    redis_client = get_redis_client()
+
+    hold_id = uuid.uuid4().hex
+    now = time.time()
+
+    arguments = [ hold_id, now + ttl, now, user_id if user_id is not None else '' ]
+    for portion_id, quantity in quantities.items() :
+        arguments.extend([ portion_id, quantity, stock.get(portion_id, 0) ])
+
+    short = redis_client.eval(PLACE_HOLD_SCRIPT, len(HOLD_KEYS), *HOLD_KEYS, *arguments)
+
+    if short :
+        return None, [ int(portion_id) for portion_id in short ]
+
+    return hold_id, []
+
+def release_stock_hold (hold_id) :
+    '''
+    Releases a hold, either because its checkout ended without payment or because the held stock
+    was decremented for an order.
+
+    Args :
+        hold_id (str) : ID of the hold.
+
+    Returns :
+        dict : quantity that was held keyed by portion ID, empty if the hold had already been released.
+    '''
+    redis_client = get_redis_client()
+
+    quantities = redis_client.eval(RELEASE_SCRIPT, len(HOLD_KEYS), *HOLD_KEYS, hold_id)
+
+    return { int(portion_id): int(quantity) for portion_id, quantity in zip(quantities[::2], quantities[1::2]) }
+
+def release_expired_holds () :
+    '''
+    Releases holds past their expiry, in batches of `HOLD_SWEEP_BATCH`.
+
+    Returns :
+        int : number of holds released.
+    '''
+    redis_client = get_redis_client()
+
+    released = 0
+
+    while True :
+        count = redis_client.eval(SWEEP_SCRIPT, len(HOLD_KEYS), *HOLD_KEYS, time.time(), HOLD_SWEEP_BATCH)
+        released += count
+
+        if count < HOLD_SWEEP_BATCH :
+            return released
+
+def start_hold_sweeper (app) :
+    '''
+    Releases expired holds every `HOLD_SWEEP_INTERVAL` seconds in a background thread. Every worker may run
+    a sweeper, releasing a hold is atomic and idempotent.
+
+    Args :
+        app (Flask) : application whose logger reports sweep errors.
+
+    Returns :
+        Thread : the sweeping thread.
+    '''
+    def sweep () :
+        while True :
+            try :
+                release_expired_holds()
+            except Exception as error :
+                app.logger.error(f'Error releasing expired stock holds: {str(error)}')
+
+            time.sleep(HOLD_SWEEP_INTERVAL)
+
+    thread = threading.Thread(target = sweep, name = 'stock-hold-sweeper', daemon = True)
+    thread.start()
+
+    return thread
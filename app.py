@@ -1,11 +1,12 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
+import click
 import stripe
 import os
 
 from .config import config
-from .database import init_db
+from .database import db, init_db
 from .redis_config import init_redis, get_redis_client
 
 def create_app () : 
@@ -26,6 +27,10 @@ def create_app () :
     env = os.getenv('FLASK_ENV', 'development')
     app.config.from_object(config[env])
 
+    # serialize every JSON response with orjson
+    from .api.utils.json_provider import OrjsonProvider
+    app.json = OrjsonProvider(app)
+
     # initiailize stripe and secret API key
     stripe.api_key = app.config['STRIPE_API_KEY']
     webhook_secret = app.config['WEBHOOK_SECRET']
@@ -36,6 +41,18 @@ def create_app () :
     init_db(app)
     init_redis(app.config['REDIS_URL'])
 
+    # purge cached products whenever products or portions are committed
+    from .api.utils.cache_invalidation import register_cache_invalidation
+    register_cache_invalidation(db.session)
+
+    # keep this worker's local product caches coherent with changes made by other workers
+    from .api.utils.redis_service import start_cache_invalidation_listener
+    start_cache_invalidation_listener()
+
+    # return stock held by abandoned checkouts
+    from .api.utils.stock_holds import start_hold_sweeper
+    start_hold_sweeper(app)
+
     # import blueprints 
     from .api.blueprints.product import product_bp
     from .api.blueprints.user import user_bp
@@ -101,6 +118,21 @@ def create_app () :
         return response
 
 
+    @app.cli.command('snapshot-inventory')
+    def snapshot_inventory_command () :
+        '''
+        Compacts the inventory ledger into per-portion snapshots and reports portions whose stock drifted
+        from the ledger. Meant to run periodically, e.g. hourly from cron.
+        '''
+        from .api.models.inventory import snapshot_inventory
+
+        written, drifted = snapshot_inventory()
+        click.echo(f'Wrote {written} inventory snapshots')
+
+        if drifted :
+            app.logger.error(f'Portions with stock drifted from the inventory ledger: {drifted}')
+
+
     # basic test route
     @app.route('/')
     def home () :
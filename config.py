@@ -8,6 +8,11 @@ class Config :
     REDIS_URL = os.getenv('REDIS_URL')
     MAX_REQUESTS = 60
     RATE_LIMIT_WINDOW = 60
+    CATALOG_CACHE_MAX_AGE = 30
+    MAX_CONTENT_LENGTH = 11 * 1024 * 1024 # image uploads are capped at 10 MB, plus room for the form fields
+    LISTING_ENGINE = os.getenv('LISTING_ENGINE', 'orm') # 'orm' or 'json_agg'
+    CHECKOUT_SESSION_TTL = 1860 # seconds a Stripe checkout stays open, a minute over Stripe's 30 minute minimum to absorb latency and clock skew
+    STOCK_HOLD_GRACE_PERIOD = 300 # seconds stock stays held past checkout expiry, covering late webhooks
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -0,0 +1,26 @@
+"""adds needs restock index to portion
+
+Revision ID: 3f7b9d2c6e15
+Revises: 8c4f1a6e2d93
+Create Date: 2026-10-17 14:21:47.103286
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7b9d2c6e15'
+down_revision = '8c4f1a6e2d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('portions', schema=None) as batch_op:
+        batch_op.create_index('ix_portions_needs_restock', ['product_id', 'id'], unique=False, postgresql_where=sa.text('stock < optimal_stock - 5'))
+
+
+def downgrade():
+    with op.batch_alter_table('portions', schema=None) as batch_op:
+        batch_op.drop_index('ix_portions_needs_restock', postgresql_where=sa.text('stock < optimal_stock - 5'))
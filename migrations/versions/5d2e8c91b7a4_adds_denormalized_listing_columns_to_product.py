@@ -0,0 +1,85 @@
+"""adds denormalized listing columns to product
+
+Revision ID: 5d2e8c91b7a4
+Revises: 14b46028641f
+Create Date: 2026-10-17 09:12:44.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8c91b7a4'
+down_revision = '14b46028641f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('total_stock', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('whole_price', sa.Numeric(precision=5, scale=2), server_default='0', nullable=False))
+
+    with op.batch_alter_table('portions', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_portions_product_id'), ['product_id'], unique=False)
+
+    # recomputes the denormalized columns of one product from its portions
+    op.execute('''
+        CREATE FUNCTION refresh_product_totals (target integer) RETURNS void AS $$
+            UPDATE products SET
+                total_stock = COALESCE((SELECT SUM(stock) FROM portions WHERE product_id = target), 0),
+                whole_price = COALESCE((SELECT price FROM portions WHERE product_id = target AND size = 'WHOLE' LIMIT 1), 0)
+            WHERE id = target;
+        $$ LANGUAGE sql;
+    ''')
+
+    op.execute('''
+        CREATE FUNCTION sync_product_totals () RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM refresh_product_totals(NEW.product_id);
+            END IF;
+
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.product_id <> NEW.product_id) THEN
+                PERFORM refresh_product_totals(OLD.product_id);
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    op.execute('''
+        CREATE TRIGGER portions_sync_product_totals
+        AFTER INSERT OR DELETE OR UPDATE OF stock, price, size, product_id ON portions
+        FOR EACH ROW EXECUTE FUNCTION sync_product_totals();
+    ''')
+
+    # backfill existing products
+    op.execute('SELECT refresh_product_totals(id) FROM products')
+
+    op.execute('CREATE INDEX ix_products_listing_stock ON products (total_stock DESC, id)')
+    op.execute('CREATE INDEX ix_products_listing_price_asc ON products ((total_stock > 0) DESC, whole_price, id)')
+    op.execute('CREATE INDEX ix_products_listing_price_desc ON products ((total_stock > 0) DESC, whole_price DESC, id DESC)')
+    op.execute('CREATE INDEX ix_products_listing_name_asc ON products ((total_stock > 0) DESC, name, id)')
+    op.execute('CREATE INDEX ix_products_listing_name_desc ON products ((total_stock > 0) DESC, name DESC, id DESC)')
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_products_listing_name_desc')
+    op.execute('DROP INDEX ix_products_listing_name_asc')
+    op.execute('DROP INDEX ix_products_listing_price_desc')
+    op.execute('DROP INDEX ix_products_listing_price_asc')
+    op.execute('DROP INDEX ix_products_listing_stock')
+
+    op.execute('DROP TRIGGER portions_sync_product_totals ON portions')
+    op.execute('DROP FUNCTION sync_product_totals()')
+    op.execute('DROP FUNCTION refresh_product_totals(integer)')
+
+    with op.batch_alter_table('portions', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_portions_product_id'))
+
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_column('whole_price')
+        batch_op.drop_column('total_stock')
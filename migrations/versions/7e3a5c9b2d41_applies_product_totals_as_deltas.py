@@ -0,0 +1,79 @@
+"""applies product totals as deltas
+
+Revision ID: 7e3a5c9b2d41
+Revises: c42e7a9f1b08
+Create Date: 2026-10-17 19:05:37.604512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3a5c9b2d41'
+down_revision = 'c42e7a9f1b08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # stock changes are applied as deltas to the locked product row, so a writer that waited on the lock adds
+    # its change to the committed total instead of writing a total it read before the wait.
+    # whole_price is only touched when a whole portion's price, size or product changes
+    op.execute('''
+        CREATE OR REPLACE FUNCTION sync_product_totals () RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.product_id = NEW.product_id THEN
+                IF OLD.stock <> NEW.stock THEN
+                    UPDATE products SET total_stock = total_stock + NEW.stock - OLD.stock WHERE id = NEW.product_id;
+                END IF;
+            ELSE
+                IF TG_OP <> 'DELETE' THEN
+                    UPDATE products SET total_stock = total_stock + NEW.stock WHERE id = NEW.product_id;
+                END IF;
+
+                IF TG_OP <> 'INSERT' THEN
+                    UPDATE products SET total_stock = total_stock - OLD.stock WHERE id = OLD.product_id;
+                END IF;
+            END IF;
+
+            IF TG_OP <> 'DELETE' AND NEW.size = 'WHOLE' AND (
+                TG_OP = 'INSERT' OR OLD.price <> NEW.price OR OLD.size <> NEW.size OR OLD.product_id <> NEW.product_id
+            ) THEN
+                UPDATE products SET whole_price = NEW.price WHERE id = NEW.product_id;
+            END IF;
+
+            IF TG_OP <> 'INSERT' AND OLD.size = 'WHOLE' AND (
+                TG_OP = 'DELETE' OR OLD.size <> NEW.size OR OLD.product_id <> NEW.product_id
+            ) THEN
+                UPDATE products SET
+                    whole_price = COALESCE((SELECT price FROM portions WHERE product_id = OLD.product_id AND size = 'WHOLE' LIMIT 1), 0)
+                WHERE id = OLD.product_id;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    # repair totals that a lost update may have left stale
+    op.execute('LOCK TABLE portions IN SHARE MODE')
+    op.execute('SELECT refresh_product_totals(id) FROM products')
+
+
+def downgrade():
+    op.execute('''
+        CREATE OR REPLACE FUNCTION sync_product_totals () RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM refresh_product_totals(NEW.product_id);
+            END IF;
+
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.product_id <> NEW.product_id) THEN
+                PERFORM refresh_product_totals(OLD.product_id);
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
@@ -0,0 +1,28 @@
+"""adds trigram search index to product
+
+Revision ID: 8c4f1a6e2d93
+Revises: 5d2e8c91b7a4
+Create Date: 2026-10-17 10:03:18.552914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4f1a6e2d93'
+down_revision = '5d2e8c91b7a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.create_index('ix_products_name_trgm', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_index('ix_products_name_trgm', postgresql_using='gin')
@@ -0,0 +1,60 @@
+"""adds inventory ledger
+
+Revision ID: c42e7a9f1b08
+Revises: 3f7b9d2c6e15
+Create Date: 2026-10-17 16:40:12.318904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c42e7a9f1b08'
+down_revision = '3f7b9d2c6e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('inventory_movements',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('portion_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.Enum('RESTOCK', 'SALE', 'ADJUSTMENT', name='movement_kind'), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text("(now() at time zone 'utc')"), nullable=False),
+    sa.ForeignKeyConstraint(['portion_id'], ['portions.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('inventory_movements', schema=None) as batch_op:
+        batch_op.create_index('ix_inventory_movements_portion_created_at', ['portion_id', 'created_at'], unique=False)
+
+    op.create_table('inventory_snapshots',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('portion_id', sa.Integer(), nullable=False),
+    sa.Column('stock', sa.Integer(), nullable=False),
+    sa.Column('taken_at', sa.TIMESTAMP(), nullable=False),
+    sa.ForeignKeyConstraint(['portion_id'], ['portions.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('inventory_snapshots', schema=None) as batch_op:
+        batch_op.create_index('ix_inventory_snapshots_portion_taken_at', ['portion_id', 'taken_at'], unique=False)
+
+    # opening balances, so every portion's movements add up to its current stock
+    op.execute('''
+        INSERT INTO inventory_movements (portion_id, quantity, kind)
+        SELECT id, stock, 'ADJUSTMENT' FROM portions WHERE stock <> 0
+    ''')
+
+
+def downgrade():
+    with op.batch_alter_table('inventory_snapshots', schema=None) as batch_op:
+        batch_op.drop_index('ix_inventory_snapshots_portion_taken_at')
+
+    op.drop_table('inventory_snapshots')
+
+    with op.batch_alter_table('inventory_movements', schema=None) as batch_op:
+        batch_op.drop_index('ix_inventory_movements_portion_created_at')
+
+    op.drop_table('inventory_movements')
+    op.execute('DROP TYPE movement_kind')
@@ -2,13 +2,16 @@ import pytest
 import unittest
 import random
 
+from flask import jsonify
 from unittest.mock import patch
 from sqlalchemy.sql.expression import func
 
 from ..database import db
 from ..config import config
-from ..api.models import Order, Address, Cart_Item, Product, Category, Task
+from ..api.models import Order, Address, Cart_Item, Product, Category, Task, Portion
 from ..api.models.order import  Order_Status, Deliver_Method, Pay_Status
+from ..api.utils.stock_holds import place_stock_hold, release_stock_hold, release_expired_holds, HELD_STOCK_KEY, HOLD_DEADLINES_KEY, HOLD_USERS_KEY
+from ..redis_config import get_redis_client
 
 @pytest.fixture(scope = 'module')
 def seed_database (create_client_user) :
@@ -154,6 +157,211 @@ def test_handle_stripe_webhook (flask_app, create_client_user, user_login, mock_
             unittest.TestCase().assertDictEqual(created_order.cart_items[0].as_dict(), cart_item.as_dict())
 
 
+def test_reserve_stock (flask_app) :
+    product = Product(
+        name = 'Reserved Product',
+        description = 'Description',
+        category = Category.PIE,
+    )
+    db.session.add(product)
+    db.session.flush()
+
+    portions = product.create_portions(10.00)
+    db.session.add_all(portions)
+
+    for portion in portions :
+        portion.update_stock(5)
+
+    db.session.commit()
+
+    first, second = portions[0], portions[1]
+
+    # one short line fails the whole reservation and reports only that line
+    reserved, unfulfilled = Portion.reserve_stock({ first.id: 2, second.id: 6 })
+    db.session.commit()
+
+    assert reserved == {}
+    assert unfulfilled == [second.id]
+    assert db.session.get(Portion, first.id).stock == 5
+
+    reserved, unfulfilled = Portion.reserve_stock({ first.id: 2, second.id: 5 })
+    db.session.commit()
+
+    assert unfulfilled == []
+    assert reserved == { first.id: (product.id, 3), second.id: (product.id, 0) }
+    assert db.session.get(Portion, second.id).stock == 0
+
+
+def test_stock_hold (flask_app) :
+    redis_client = get_redis_client()
+
+    # portion ids outside of the seeded range, so the test does not share holds with real portions
+    first, second = 900001, 900002
+    stock = { first: 5, second: 2 }
+
+    hold_id, short = place_stock_hold({ first: 3, second: 2 }, stock, 60)
+
+    assert hold_id is not None
+    assert short == []
+    assert int(redis_client.hget(HELD_STOCK_KEY, first)) == 3
+
+    # only 2 of the first portion are still available, one short line holds nothing
+    other_hold_id, short = place_stock_hold({ first: 3, second: 0 }, stock, 60)
+
+    assert other_hold_id is None
+    assert short == [first]
+    assert int(redis_client.hget(HELD_STOCK_KEY, first)) == 3
+
+    # releasing returns the held quantities, and a second release finds nothing
+    assert release_stock_hold(hold_id) == { first: 3, second: 2 }
+    assert release_stock_hold(hold_id) == {}
+
+    assert redis_client.hget(HELD_STOCK_KEY, first) is None
+    assert redis_client.zscore(HOLD_DEADLINES_KEY, hold_id) is None
+
+def test_stock_hold_expiry (flask_app) :
+    redis_client = get_redis_client()
+
+    portion_id = 900003
+    stock = { portion_id: 2 }
+
+    # a hold already past its expiry is released by the sweeper
+    hold_id, short = place_stock_hold({ portion_id: 2 }, stock, -1)
+    assert hold_id is not None
+
+    assert release_expired_holds() >= 1
+    assert redis_client.hget(HELD_STOCK_KEY, portion_id) is None
+    assert release_stock_hold(hold_id) == {}
+
+    # placing a hold frees expired holds first, without waiting for the sweeper
+    place_stock_hold({ portion_id: 2 }, stock, -1)
+    hold_id, short = place_stock_hold({ portion_id: 2 }, stock, 60)
+
+    assert short == []
+    assert int(redis_client.hget(HELD_STOCK_KEY, portion_id)) == 2
+
+    release_stock_hold(hold_id)
+
+def test_stock_hold_replaces_user_hold (flask_app) :
+    redis_client = get_redis_client()
+
+    portion_id = 900005
+    stock = { portion_id: 2 }
+
+    hold_id, short = place_stock_hold({ portion_id: 2 }, stock, 60, 900001)
+    assert short == []
+
+    # the user's next checkout replaces their hold, so the units they held are available to it
+    new_hold_id, short = place_stock_hold({ portion_id: 2 }, stock, 60, 900001)
+
+    assert short == []
+    assert int(redis_client.hget(HELD_STOCK_KEY, portion_id)) == 2
+    assert redis_client.hget(HOLD_USERS_KEY, 900001) == new_hold_id
+    assert release_stock_hold(hold_id) == {}
+
+    # another user's checkout still finds the units held
+    other_hold_id, short = place_stock_hold({ portion_id: 1 }, stock, 60, 900002)
+
+    assert other_hold_id is None
+    assert short == [portion_id]
+
+    # releasing the hold forgets it as the user's hold
+    assert release_stock_hold(new_hold_id) == { portion_id: 2 }
+    assert redis_client.hget(HOLD_USERS_KEY, 900001) is None
+
+def test_create_checkout_session_insufficient_stock (flask_app, create_client_user, user_login, mock_auth, seed_database) :
+    user_login
+
+    user = create_client_user
+    cart_item, address = seed_database
+
+    # ask for more than the portion's stock
+    cart = [{ **cart_item.as_dict(), 'quantity': cart_item.portion.stock + 1 }]
+
+    # the user's earlier checkouts may still hold some of the portion
+    held = int(get_redis_client().hget(HELD_STOCK_KEY, cart_item.portion_id) or 0)
+
+    with mock_auth(user.id, 'user'), \
+        patch('stripe.checkout.Session.create') as mock_create_session :
+
+        response = flask_app.post('/api/order/create-checkout-session',
+            json = {
+                'cart': cart,
+                'method': 'STANDARD',
+                'billing': address.as_dict(),
+                'shipping': address.as_dict()
+            },
+        )
+
+    assert response.status_code == 409
+    assert response.json['portions'] == [cart_item.portion_id]
+
+    # no checkout is created and nothing more is held, the user's previous hold was replaced by nothing
+    mock_create_session.assert_not_called()
+    assert int(get_redis_client().hget(HELD_STOCK_KEY, cart_item.portion_id) or 0) <= held
+    assert get_redis_client().hget(HOLD_USERS_KEY, user.id) is None
+
+@pytest.mark.parametrize('status_code, released', [
+    (409, True), # stock is definitely short, the hold is done
+    (500, False), # transient failure, the hold is kept for Stripe's retry
+])
+def test_handle_stripe_webhook_hold (flask_app, create_client_user, seed_database, status_code, released) :
+    user = create_client_user
+    cart_item, address = seed_database
+
+    hold_id, short = place_stock_hold({ cart_item.portion_id: 1 }, { cart_item.portion_id: 1 }, 60)
+
+    mock_payload_data = {
+        'type': 'checkout.session.completed',
+        'data': {
+            'object': {
+                'id': 'cs_123456789',
+                'metadata': {
+                    'method': 'STANDARD',
+                    'user': str(user.id),
+                    'address_id': str(address.id),
+                    'hold_id': hold_id
+                },
+                'payment_intent': '123456789'
+            },
+        }
+    }
+
+    with patch('backend.api.blueprints.order.webhook_secret', 'mock_webhook_secret'), \
+        patch('stripe.Webhook.construct_event', return_value = mock_payload_data), \
+        patch('backend.api.blueprints.order.create_order', return_value = (jsonify({ 'error': 'Order failed' }), status_code)) :
+
+        response = flask_app.post('/api/order/stripe-webhook', json = mock_payload_data)
+
+    assert response.status_code == status_code
+
+    # releasing again returns the held quantity only if the webhook kept the hold
+    assert release_stock_hold(hold_id) == ({} if released else { cart_item.portion_id: 1 })
+
+def test_handle_stripe_webhook_expired (flask_app) :
+    hold_id, short = place_stock_hold({ 900004: 1 }, { 900004: 1 }, 60)
+
+    mock_payload_data = {
+        'type': 'checkout.session.expired',
+        'data': {
+            'object': {
+                'id': 'cs_123456789',
+                'metadata': { 'hold_id': hold_id },
+            },
+        }
+    }
+
+    with patch('backend.api.blueprints.order.webhook_secret', 'mock_webhook_secret'), \
+        patch('stripe.Webhook.construct_event', return_value = mock_payload_data) :
+
+        response = flask_app.post('/api/order/stripe-webhook', json = mock_payload_data)
+
+    assert response.status_code == 200
+
+    # the abandoned checkout's hold was released
+    assert release_stock_hold(hold_id) == {}
+
+
 @pytest.mark.parametrize('requesting_recents', (True, False))
 def test_order_history (flask_app, create_client_user, user_login, mock_auth,seed_database, requesting_recents) :
     user_login
@@ -207,6 +415,29 @@ def test_show_order (flask_app, create_client_user, user_login, mock_auth) :
     unittest.TestCase().assertDictEqual(order_dict, response.json['order'])
 
 
+def test_order_as_dict_product_changes (flask_app, create_client_user) :
+    user = create_client_user
+
+    order = Order.query.filter_by(user_id = user.id).first()
+    assert order is not None
+
+    # first render memoizes the order
+    order.as_dict()
+
+    product = order.cart_items[0].product
+    name = product.name
+
+    product.name = f'{name} renamed'
+    db.session.commit()
+
+    # the memoized order still shows the product's current name
+    assert order.as_dict()['cartItems'][0]['product']['name'] == f'{name} renamed'
+
+    # restore the name other tests look the product up by
+    product.name = name
+    db.session.commit()
+
+
 @pytest.mark.parametrize('status, is_filter, is_search', [
     ('pending', False, False),
     ('pending', True, False),
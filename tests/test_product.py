@@ -2,13 +2,27 @@ import pytest
 import unittest
 import random
 import os
+import io
+import time
+import json
+import uuid
 
 
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
+from PIL import Image
 
 from ..database import db
-from ..api.models import Product, Category, Role
+from ..redis_config import get_redis_client
+from ..api.models import Product, Category, Role, Portion
+from ..api.models.inventory import Inventory_Movement, Inventory_Snapshot, Movement_Kind, stock_at, snapshot_inventory
+from ..api.utils.local_cache import LocalCache, product_cache, page_cache
+from ..api.utils.image_pipeline import enqueue_product_image
+from ..api.utils.aws_s3 import max_file_size_bytes, max_image_pixels, image_renditions, image_formats, primary_rendition, immutable_cache_control, render_image_renditions, s3_photo_upload
+from ..api.utils.redis_service import CACHE_INVALIDATION_CHANNEL, CATALOG_VERSION_KEY, CATALOG_TTL, CATALOG_GRACE_PERIOD, CATALOG_REBUILD_LOCK_KEY, CATALOG_REFRESH_AT_KEY, CATALOG_REVISION_KEY, FILTERED_PAGES_KEY, FILTERED_PAGES_MAX, FILTERED_PAGE_TTL, FILTERED_PAGE_EMPTY_TTL, CATALOG_TTL_JITTER, ensure_catalog_cache, cache_products, cache_product_entries, get_product_revisions, invalidate_products, get_product_cache, get_product_cache_raw, get_filtered_products_cache, cache_filtered_products, filtered_products_cache_key, clear_local_caches, start_cache_invalidation_listener, _catalog_products_key
 
 
 @pytest.mark.parametrize('valid_image', [True, False])
@@ -116,6 +130,141 @@ def test_product_index (flask_app, requesting_category, searching) :
         unittest.TestCase().assertListEqual([], response.json['products'])
         assert response.json['message'] == 'No products found'
 
+@pytest.mark.parametrize('sort, search', [
+    (None, None),
+    ('priceAsc', None),
+    ('priceDesc', None),
+    ('nameAsc', None),
+    ('nameDesc', None),
+    (None, 'product'), # ranked by relevance, with many products sharing a score
+])
+def test_product_index_cursor (flask_app, sort, search) :
+    query_params = { key: value for key, value in [('sort', sort), ('search', search)] if value }
+
+    seen_ids = []
+    cursor = ''
+
+    # walk every page using the cursor from the previous response
+    while cursor is not None :
+        response = flask_app.get('/api/product/',
+            query_string = { **query_params, 'cursor': cursor }
+        )
+
+        assert response.status_code == 200
+
+        seen_ids.extend(product['id'] for product in response.json['products'])
+        cursor = response.json['nextCursor']
+
+    # base query for count of products, restricted to the search if present
+    count_query = Product.query
+
+    if search :
+        count_query = count_query.filter(Product.name.ilike(f'%{search}%'))
+
+    # every product is returned exactly once
+    assert len(seen_ids) == len(set(seen_ids))
+    assert len(seen_ids) == count_query.count()
+
+@pytest.mark.parametrize('sort', [None, 'priceAsc', 'priceDesc', 'nameAsc', 'nameDesc'])
+@pytest.mark.parametrize('category', [None, *[ category.value.lower() for category in Category ]])
+def test_product_index_sorted_set_order (flask_app, sort, category) :
+    # rebuild the catalog from the database, so its indexes hold every product other tests wrote
+    cache_products(Product.query.options(selectinload(Product.portions)).all())
+
+    query_params = { key: value for key, value in [('sort', sort), ('category', category)] if value }
+
+    # pages served from the sorted set indexes list the products in the order the database sorts them
+    assert listing_ids_by_page(flask_app, query_params) == listing_ids_by_cursor(flask_app, query_params)
+
+
+def test_product_index_invalid_cursor (flask_app) :
+    response = flask_app.get('/api/product/', query_string = { 'cursor': 'invalid' })
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid cursor'
+
+@pytest.mark.parametrize('page', [0, -1])
+def test_product_index_invalid_page (flask_app, page) :
+    response = flask_app.get('/api/product/', query_string = { 'page': page })
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid page'
+
+
+@pytest.mark.parametrize('fields, expected_keys', [
+    ('card', {'id', 'name', 'image', 'category', 'price', 'soldOut'}),
+    ('name,price', {'id', 'name', 'price'}),
+])
+def test_product_index_fields (flask_app, fields, expected_keys) :
+    response = flask_app.get('/api/product/', query_string = { 'fields': fields })
+
+    assert response.status_code == 200
+
+    # every product carries exactly the requested fields
+    for product in response.json['products'] :
+        assert set(product.keys()) == expected_keys
+
+@pytest.fixture(scope = 'module')
+def listing_engine_products () :
+    products = []
+
+    for index, price in enumerate([12.00, 9.50, 20.00]) :
+        product = Product(
+            name = f'Engine Product {index}',
+            description = 'Description',
+            category = Category.CAKE,
+        )
+        db.session.add(product)
+        db.session.flush()
+
+        portions = product.create_portions(price)
+        db.session.add_all(portions)
+
+        for portion in portions :
+            portion.update_stock(index)
+
+        products.append(product)
+
+    db.session.commit()
+
+    # rewrite the first portion of each product so its row moves after the others on disk
+    for product in products :
+        product.portions[0].update_stock(5)
+
+    db.session.commit()
+
+    return products
+
+@pytest.mark.parametrize('fields', [None, 'card', 'name,price'])
+def test_product_index_json_agg (flask_app, listing_engine_products, fields) :
+    query_params = { key: value for key, value in [('search', 'engine product'), ('sort', 'priceAsc'), ('fields', fields)] if value }
+    cache_key = filtered_products_cache_key(1, None, 'engine product', 'priceAsc')
+
+    responses = {}
+
+    for engine in ['orm', 'json_agg'] :
+        # drop the cached page so that it is built by the engine under test
+        page_cache.clear()
+        get_redis_client().delete(cache_key, f'{cache_key}:metadata')
+
+        with patch.dict(flask_app.application.config, { 'LISTING_ENGINE': engine }) :
+            response = flask_app.get('/api/product/', query_string = query_params)
+
+        assert response.status_code == 200
+        responses[engine] = response.json
+
+    assert [ product['id'] for product in responses['orm']['products'] ] == [ product.id for product in sorted(listing_engine_products, key = lambda product : product.whole_price) ]
+
+    # the page built in SQL matches the page serialized from ORM objects, down to how numbers are written
+    assert json.dumps(responses['json_agg'], sort_keys = True) == json.dumps(responses['orm'], sort_keys = True)
+
+
+def test_product_index_unknown_fields (flask_app) :
+    response = flask_app.get('/api/product/', query_string = { 'fields': 'name,secret' })
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Unknown fields: secret'
+
 def test_product_show (flask_app) :
     product = Product.query.filter_by(name = 'Product 1').first()
     assert product is not None
@@ -126,6 +275,320 @@ def test_product_show (flask_app) :
     unittest.TestCase().assertDictEqual(product.as_dict(), response.json['product'])
 
 
+def test_cache_products_generation_swap (flask_app) :
+    redis_client = get_redis_client()
+    products = Product.query.options(selectinload(Product.portions)).all()
+
+    cache_products(products)
+    previous_version = redis_client.get(CATALOG_VERSION_KEY)
+
+    cache_products(products)
+    version = redis_client.get(CATALOG_VERSION_KEY)
+
+    # the pointer moves to a complete new generation, and the replaced one only lingers for in-flight readers
+    assert int(version) > int(previous_version)
+    assert redis_client.hlen(_catalog_products_key(version)) == len(products)
+    assert 0 < redis_client.ttl(_catalog_products_key(previous_version)) <= CATALOG_GRACE_PERIOD
+    assert redis_client.ttl(_catalog_products_key(version)) > CATALOG_GRACE_PERIOD
+    assert 0 < redis_client.ttl(CATALOG_VERSION_KEY) <= CATALOG_TTL * (1 + CATALOG_TTL_JITTER)
+
+    for product in products :
+        assert get_product_cache(product.id) == product.as_dict()
+
+    # products are no longer cached under per product keys
+    assert next(redis_client.scan_iter('all_products:*'), None) is None
+
+
+def test_catalog_rebuild_single_flight (flask_app) :
+    redis_client = get_redis_client()
+    load_products = MagicMock(side_effect = lambda : Product.query.options(selectinload(Product.portions)).all())
+
+    # the refresh deadline passed, but another worker holds the rebuild lock
+    redis_client.delete(CATALOG_REFRESH_AT_KEY)
+    redis_client.set(CATALOG_REBUILD_LOCK_KEY, 'other worker')
+
+    assert ensure_catalog_cache(load_products) is False
+    load_products.assert_not_called()
+    assert redis_client.get(CATALOG_REBUILD_LOCK_KEY) == 'other worker'
+
+    # once the lock is free, one caller rebuilds and the next finds a fresh generation
+    redis_client.delete(CATALOG_REBUILD_LOCK_KEY)
+
+    assert ensure_catalog_cache(load_products) is True
+    assert ensure_catalog_cache(load_products) is False
+    assert load_products.call_count == 1
+    assert redis_client.get(CATALOG_REBUILD_LOCK_KEY) is None
+
+def test_catalog_rebuild_lock_takeover (flask_app) :
+    redis_client = get_redis_client()
+
+    def load_products () :
+        # the lock expires during the load and another worker takes it
+        redis_client.set(CATALOG_REBUILD_LOCK_KEY, 'other worker')
+        return Product.query.options(selectinload(Product.portions)).all()
+
+    redis_client.delete(CATALOG_REFRESH_AT_KEY, CATALOG_REBUILD_LOCK_KEY)
+
+    assert ensure_catalog_cache(load_products) is True
+
+    # releasing only deletes the caller's own lock
+    assert redis_client.get(CATALOG_REBUILD_LOCK_KEY) == 'other worker'
+    redis_client.delete(CATALOG_REBUILD_LOCK_KEY)
+
+def test_catalog_rebuild_overlapping_invalidation (flask_app) :
+    redis_client = get_redis_client()
+    product = Product.query.filter_by(name = 'Product 1').first()
+
+    loads = []
+
+    def load_products () :
+        products = Product.query.options(selectinload(Product.portions)).all()
+
+        # a change is invalidated while the first load is in flight
+        if not loads :
+            invalidate_products([product.id])
+
+        loads.append(products)
+        return products
+
+    redis_client.delete(CATALOG_REFRESH_AT_KEY, CATALOG_REBUILD_LOCK_KEY)
+
+    # the generation loaded before the invalidation is discarded and loaded again
+    assert ensure_catalog_cache(load_products) is True
+    assert len(loads) == 2
+
+    # a generation published with a stale revision is refused
+    revision = redis_client.get(CATALOG_REVISION_KEY) or ''
+    invalidate_products([product.id])
+
+    assert cache_products(loads[-1], revision) is False
+
+
+def test_local_cache () :
+    cache = LocalCache(max_size = 2, ttl = 30)
+
+    cache.set(1, 'first')
+    cache.set(2, 'second')
+
+    # reading an entry makes it the most recently used, so the other one is evicted when full
+    assert cache.get(1) == 'first'
+    cache.set(3, 'third')
+
+    assert cache.get(2) is None
+    assert cache.get(1) == 'first' and cache.get(3) == 'third'
+
+    # entries expire once their TTL passes
+    with patch('backend.api.utils.local_cache.time.monotonic', return_value = time.monotonic() + 31) :
+        assert cache.get(1) is None
+
+    cache.delete(3)
+    assert cache.get(3) is None
+
+def test_local_cache_invalidation_listener (flask_app) :
+    product_ids = [1, 2]
+    listener = start_cache_invalidation_listener()
+
+    try :
+        for id in product_ids :
+            product_cache.set(id, { 'id': id })
+        page_cache.set('page', { 'products': [] })
+
+        # a change broadcast by another worker drops the product and every page from this worker
+        get_redis_client().publish(CACHE_INVALIDATION_CHANNEL, json.dumps({ 'products': product_ids[:1] }))
+
+        deadline = time.monotonic() + 5
+        while product_cache.get(product_ids[0]) is not None and time.monotonic() < deadline :
+            time.sleep(0.05)
+
+        assert product_cache.get(product_ids[0]) is None
+        assert page_cache.get('page') is None
+        assert product_cache.get(product_ids[1]) == { 'id': product_ids[1] }
+
+    finally :
+        listener.stop()
+        clear_local_caches()
+
+
+def test_product_cache_invalidation (flask_app) :
+    product = Product.query.filter_by(name = 'Product 1').first()
+    portion = product.portions[0]
+
+    # warm the product entry and a filtered page containing the product
+    flask_app.get(f'/api/product/{product.id}')
+    flask_app.get('/api/product/', query_string = { 'search': 'Product 1' })
+
+    page_key = filtered_products_cache_key(1, None, 'Product 1', None)
+
+    assert get_product_cache_raw(product.id) is not None
+    assert product.id in get_filtered_products_cache(page_key)['ids']
+
+    # committing a price change purges the product and every page containing it
+    portion.price = portion.price + 1
+    db.session.commit()
+
+    assert get_product_cache_raw(product.id) is None
+    assert get_filtered_products_cache(page_key) is None
+
+    # the next read serves the new price and writes the product back into cache
+    response = flask_app.get(f'/api/product/{product.id}')
+
+    assert response.status_code == 200
+
+    for cached_product in [response.json['product'], get_product_cache(product.id)] :
+        prices = { cached_portion['id']: cached_portion['price'] for cached_portion in cached_product['portions'] }
+        assert prices[portion.id] == float(portion.price)
+
+
+def test_filtered_products_cache_partial_miss (flask_app) :
+    redis_client = get_redis_client()
+    query_params = { 'search': 'Product' }
+
+    cache_products(Product.query.options(selectinload(Product.portions)).all())
+
+    response = flask_app.get('/api/product/', query_string = query_params)
+    assert response.status_code == 200
+
+    ids = [ product['id'] for product in response.json['products'] ]
+    page_key = filtered_products_cache_key(1, None, query_params['search'], None)
+
+    # one product of the cached page drops out of the catalog generation
+    version = redis_client.get(CATALOG_VERSION_KEY)
+    redis_client.hdel(_catalog_products_key(version), ids[0])
+    clear_local_caches()
+
+    cached_page = get_filtered_products_cache(page_key)
+
+    # the page is hydrated from the generation, reporting only the product it is missing
+    assert cached_page['ids'] == ids
+    assert set(cached_page['products']) == set(ids[1:])
+    assert cached_page['missingIds'] == [ids[0]]
+
+    # serving the page refills the missing product from the database and writes it back
+    response = flask_app.get('/api/product/', query_string = query_params)
+
+    assert response.status_code == 200
+    assert [ product['id'] for product in response.json['products'] ] == ids
+    assert redis_client.hexists(_catalog_products_key(version), ids[0])
+
+
+@pytest.mark.parametrize('query, equivalent_query', [
+    ((1, 'cake', 'Chocolate Cake', None), (1, 'CAKE', '  chocolate   CAKE ', None)), # case and whitespace
+    ((1, None, None, None), (1, '', '', 'unknown')), # missing filters and unknown sorts
+    ((2, None, 'cake', 'priceAsc'), (2, None, 'Cake', 'priceAsc')),
+])
+def test_filtered_products_cache_key (query, equivalent_query) :
+    assert filtered_products_cache_key(*query) == filtered_products_cache_key(*equivalent_query)
+
+@pytest.mark.parametrize('query, other_query', [
+    ((1, None, 'cake', None), (2, None, 'cake', None)),
+    ((1, None, 'cake', None), (1, None, 'cookie', None)),
+    ((1, None, 'cake', 'priceAsc'), (1, None, 'cake', 'priceDesc')),
+    ((1, 'cake', None, None), (1, 'cookie', None, None)),
+])
+def test_filtered_products_cache_key_distinct (query, other_query) :
+    assert filtered_products_cache_key(*query) != filtered_products_cache_key(*other_query)
+
+def test_filtered_products_cache_key_length () :
+    # search terms are hashed, so a long term does not make a long key
+    assert len(filtered_products_cache_key(1, None, 'cake ' * 1000, None)) == len(filtered_products_cache_key(1, None, 'cake', None))
+
+@pytest.mark.parametrize('product_ids, ttl', [
+    ([], FILTERED_PAGE_EMPTY_TTL),
+    ([1, 2, 3], FILTERED_PAGE_TTL),
+])
+def test_cache_filtered_products_ttl (flask_app, product_ids, ttl) :
+    redis_client = get_redis_client()
+    key = filtered_products_cache_key(1, None, f'ttl test {len(product_ids)}', None)
+
+    cache_filtered_products(key, product_ids, 1 if product_ids else 0, 1)
+
+    # pages with no results are cached too, for a shorter jittered lifetime
+    for cached_key in [key, f'{key}:metadata'] :
+        assert ttl * (1 - CATALOG_TTL_JITTER) - 1 <= redis_client.ttl(cached_key) <= ttl * (1 + CATALOG_TTL_JITTER)
+
+    assert get_filtered_products_cache(key)['ids'] == product_ids
+
+def test_cache_filtered_products_registry_cap (flask_app) :
+    redis_client = get_redis_client()
+    now = time.time()
+
+    # fill the registry with pages expiring before any new page, the first expiring soonest
+    filler_keys = [ f'filter:products:cap test:{index}' for index in range(FILTERED_PAGES_MAX) ]
+
+    redis_client.delete(FILTERED_PAGES_KEY)
+    redis_client.zadd(FILTERED_PAGES_KEY, { key: now + 60 + index for index, key in enumerate(filler_keys) })
+    redis_client.set(filler_keys[0], '[]', ex = 60)
+    redis_client.set(f'{filler_keys[0]}:metadata', '{}', ex = 60)
+
+    key = filtered_products_cache_key(1, None, 'cap test', None)
+    cache_filtered_products(key, [1], 1, 1)
+
+    # the registry stays at its cap by evicting the page expiring soonest, along with its cached keys
+    assert redis_client.zcard(FILTERED_PAGES_KEY) == FILTERED_PAGES_MAX
+    assert redis_client.zscore(FILTERED_PAGES_KEY, key) is not None
+    assert redis_client.zscore(FILTERED_PAGES_KEY, filler_keys[0]) is None
+    assert redis_client.exists(filler_keys[0], f'{filler_keys[0]}:metadata') == 0
+    assert get_filtered_products_cache(key)['ids'] == [1]
+
+    redis_client.delete(FILTERED_PAGES_KEY)
+
+
+def test_product_cache_refill_race (flask_app) :
+    product = Product.query.filter_by(name = 'Product 1').first()
+    stale = product.as_dict()
+
+    # a refill that read its revision before a change was committed and invalidated
+    revisions = get_product_revisions([product.id])
+    invalidate_products([product.id])
+
+    cache_product_entries([{ **stale, 'name': 'Stale Name' }], revisions)
+
+    # the stale row is not written back
+    assert get_product_cache_raw(product.id) is None
+
+    # a refill that read the current revision is written
+    cache_product_entries([stale], get_product_revisions([product.id]))
+
+    assert get_product_cache(product.id)['name'] == product.name
+
+
+def test_product_show_not_modified (flask_app) :
+    product = Product.query.filter_by(name = 'Product 1').first()
+
+    response = flask_app.get(f'/api/product/{product.id}')
+    etag = response.headers.get('ETag')
+
+    assert response.status_code == 200
+    assert etag is not None
+
+    # repeat request with the ETag is answered without a body
+    response = flask_app.get(f'/api/product/{product.id}', headers = { 'If-None-Match': etag })
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers.get('ETag') == etag
+
+def test_product_batch (flask_app) :
+    products = Product.query.order_by(Product.id).limit(3).all()
+    missing_id = max(product.id for product in products) + 10000
+
+    ids = [ products[2].id, missing_id, products[0].id, products[2].id ]
+    response = flask_app.get('/api/product/batch', query_string = { 'ids': ','.join(str(id) for id in ids) })
+
+    assert response.status_code == 200
+
+    # results follow the request order, with a marker for the unknown id
+    assert [ product['id'] for product in response.json['products'] ] == ids
+    assert response.json['products'][1] == { 'id': missing_id, 'error': 'Product not found' }
+    unittest.TestCase().assertDictEqual(products[0].as_dict(), response.json['products'][2])
+
+def test_product_batch_invalid_ids (flask_app) :
+    response = flask_app.get('/api/product/batch', query_string = { 'ids': '1,abc' })
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Product ids must be integers'
+
+
 @pytest.mark.parametrize('role, valid_product', [
     (Role.SUPER, True),
     (Role.SUPER, False),
@@ -168,6 +631,159 @@ def test_product_update (flask_app, create_admin_user, admin_login, mock_auth, r
         assert response.status_code == 403
         assert response.json['error'] == 'Forbidden'
 
+@pytest.mark.parametrize('file_name, status_code', [
+    ('photo.png', 200),
+    ('photo.exe', 400),
+])
+def test_product_image_upload_url (flask_app, create_admin_user, admin_login, mock_auth, file_name, status_code) :
+    admin_login
+    admin = create_admin_user
+
+    admin.role = Role.SUPER
+    db.session.commit()
+
+    product = Product.query.first()
+    presigned = { 'url': 'http://localhost:9000/bucket', 'fields': { 'key': 'uploaded' } }
+
+    with mock_auth(admin.id, 'admin'), \
+        patch('backend.api.utils.aws_s3.s3.generate_presigned_post', return_value = presigned) :
+        response = flask_app.post(f'/api/product/{product.id}/image/upload-url', json = { 'fileName': file_name })
+
+    assert response.status_code == status_code
+
+    if status_code == 200 :
+        assert response.json['upload']['url'] == presigned['url']
+        assert response.json['upload']['key'].startswith(f'uploads/products/{product.id}/')
+    else :
+        assert response.json['error'] == 'Invalid file type'
+
+def test_product_image_upload_complete_foreign_key (flask_app, create_admin_user, admin_login, mock_auth) :
+    admin_login
+    admin = create_admin_user
+
+    admin.role = Role.SUPER
+    db.session.commit()
+
+    product = Product.query.first()
+
+    # keys presigned for another product are rejected without touching S3
+    with mock_auth(admin.id, 'admin') :
+        response = flask_app.post(f'/api/product/{product.id}/image/complete', json = { 'key': 'uploads/products/0/photo.png' })
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'Upload not found'
+
+@pytest.mark.parametrize('uploaded', [True, False])
+def test_enqueue_product_image (flask_app, uploaded) :
+    product = Product.query.first()
+    previous_image = product.image
+    image_url = f'https://bucket.s3.amazonaws.com/images/{uuid.uuid4().hex}/card.jpg'
+
+    upload = MagicMock(return_value = image_url) if uploaded else MagicMock(side_effect = ValueError('Error uploading image to S3'))
+
+    # the image is processed on the pool, the caller only waits here to check the outcome
+    with patch('backend.api.utils.image_pipeline.s3_photo_upload', upload) :
+        enqueue_product_image(b'image', product.id).result()
+
+    upload.assert_called_once_with(b'image')
+
+    # the product points at the uploaded rendition, or keeps its image if processing failed
+    db.session.expire_all()
+    assert Product.query.get(product.id).image == (image_url if uploaded else previous_image)
+
+@pytest.mark.parametrize('size', [
+    max_file_size_bytes + 1, # read past the image limit
+    11 * 1024 * 1024 + 1, # over the request limit, rejected before the form is parsed
+])
+def test_product_update_image_too_large (flask_app, create_admin_user, admin_login, mock_auth, size) :
+    admin_login
+    admin = create_admin_user
+
+    admin.role = Role.SUPER
+    db.session.commit()
+
+    product = Product.query.first()
+
+    with mock_auth(admin.id, 'admin'), \
+        patch('backend.api.blueprints.product.enqueue_product_image') as mock_enqueue :
+        response = flask_app.put(f'/api/product/{product.id}/update',
+            content_type = 'multipart/form-data',
+            data = { 'image': (io.BytesIO(b'\0' * size), 'photo.png') },
+        )
+
+    assert response.status_code == 413
+    assert response.json['error'] == 'Image file is too large'
+    mock_enqueue.assert_not_called()
+
+@pytest.mark.parametrize('mode, image_format', [
+    ('RGB', 'JPEG'),
+    ('RGBA', 'PNG'),
+    ('P', 'GIF'),
+])
+def test_render_image_renditions (mode, image_format) :
+    renditions = render_image_renditions(image_file((2400, 1800), mode, image_format))
+
+    # every rendition is rendered in every format, at its own size
+    assert set(renditions) == { (name, extension) for name in image_renditions for extension in image_formats }
+
+    for (name, extension), output in renditions.items() :
+        rendition = Image.open(output)
+
+        assert rendition.size == image_renditions[name]
+        assert rendition.format == image_formats[extension][0]
+        assert rendition.mode == 'RGB'
+
+@pytest.mark.filterwarnings('ignore::PIL.Image.DecompressionBombWarning')
+def test_render_image_renditions_too_many_pixels () :
+    # a cheap to encode bitmap, one row over the pixel limit
+    width = 5000
+    file = image_file((width, max_image_pixels // width + 1), '1', 'PNG')
+
+    with pytest.raises(ValueError, match = 'Image dimensions are too large') :
+        render_image_renditions(file)
+
+def test_s3_photo_upload_content_addressed () :
+    file = image_file((1200, 900), 'RGB', 'JPEG')
+
+    mock_s3 = MagicMock()
+    mock_s3.head_object.side_effect = Exception('Not Found')
+
+    with patch('backend.api.utils.aws_s3.s3', mock_s3) :
+        first_url = s3_photo_upload(file)
+        second_url = s3_photo_upload(file)
+
+    # the same bytes are stored under the same images/{digest}/ prefix
+    assert first_url == second_url
+
+    keys = [ upload.args[2] for upload in mock_s3.upload_fileobj.call_args_list ]
+    prefix = keys[0].rsplit('/', 1)[0]
+    digest = prefix.split('/', 1)[1]
+
+    assert prefix.startswith('images/') and len(digest) == 32
+    assert first_url.endswith(f'{prefix}/{primary_rendition[0]}.{primary_rendition[1]}')
+
+    # every rendition of both calls is uploaded immutable, with the primary rendition last
+    expected_keys = { f'{prefix}/{name}.{extension}' for name in image_renditions for extension in image_formats }
+    rendition_count = len(image_renditions) * len(image_formats)
+
+    assert set(keys) == expected_keys and len(keys) == 2 * rendition_count
+    assert keys[rendition_count - 1] == keys[-1] == f'{prefix}/{primary_rendition[0]}.{primary_rendition[1]}'
+
+    for upload in mock_s3.upload_fileobj.call_args_list :
+        assert upload.kwargs['ExtraArgs']['CacheControl'] == immutable_cache_control
+
+def test_s3_photo_upload_existing_primary () :
+    mock_s3 = MagicMock()
+
+    # the primary rendition is already stored, so the whole set is
+    with patch('backend.api.utils.aws_s3.s3', mock_s3) :
+        image_url = s3_photo_upload(image_file((1200, 900), 'RGB', 'JPEG'))
+
+    mock_s3.head_object.assert_called_once()
+    mock_s3.upload_fileobj.assert_not_called()
+    assert image_url.endswith(mock_s3.head_object.call_args.kwargs['Key'])
+
+
 @pytest.mark.parametrize('valid_products, valid_portions', [
     (True, True),
     (True, False),
@@ -210,4 +826,201 @@ def test_product_update_inventory (flask_app, create_admin_user, admin_login, mo
         assert updated_product.portions[0].stock == previous_stock[0] + int(new_stock_value)
 
     else :
-        assert response.status_code == 500
\ No newline at end of file
+        assert response.status_code == 500
+
+def test_product_update_inventory_reports_missing (flask_app, create_admin_user, admin_login, mock_auth) :
+    admin_login
+    admin = create_admin_user
+
+    product = Product.query.filter(Product.portions.any()).first()
+    previous_stock = product.portions[0].stock
+
+    input = {
+        str(product.id): { str(product.portions[0].id): '5', '0': '5' },
+        '0': { '0': '5' },
+    }
+
+    with mock_auth(admin.id, 'admin') :
+        response = flask_app.put('/api/product/inventory/update', json = input)
+
+    # every missing id is reported at once and nothing is applied
+    assert response.status_code == 500
+    assert response.json['error'] == 'Error updating inventory: Products with ids 0 were not found; Portions with ids 0 were not found'
+
+    db.session.expire_all()
+    assert Product.query.get(product.id).portions[0].stock == previous_stock
+
+def test_product_generate_inventory_report (flask_app, create_admin_user, admin_login, mock_auth) :
+    admin_login
+    admin = create_admin_user
+
+    product = Product.query.filter(Product.portions.any()).first()
+    low_portion, *other_portions = product.portions
+
+    low_portion.update_stock(0)
+    for portion in other_portions :
+        portion.update_stock(portion.optimal_stock)
+    db.session.commit()
+
+    with mock_auth(admin.id, 'admin') :
+        response = flask_app.get('/api/product/inventory/generate-report')
+
+    assert response.status_code == 200
+
+    # only the low stock portion is reported, with the quantity needed to reach optimal stock
+    reported = next(item for item in response.json['products'] if item['id'] == product.id)
+    assert [ portion['id'] for portion in reported['portions'] ] == [low_portion.id]
+    assert response.json['updatedPortionsState'][str(product.id)] == { str(low_portion.id): low_portion.optimal_stock }
+
+@pytest.mark.parametrize('at, status_code', [
+    ('2026-01-01T00:00:00+00:00', 200),
+    ('yesterday', 400),
+])
+def test_product_inventory_stock_at (flask_app, create_admin_user, admin_login, mock_auth, at, status_code) :
+    admin_login
+    admin = create_admin_user
+
+    with mock_auth(admin.id, 'admin') :
+        response = flask_app.get('/api/product/inventory/stock', query_string = { 'at': at })
+
+    assert response.status_code == status_code
+
+    if status_code == 200 :
+        assert response.json['at'] == '2026-01-01T00:00:00'
+        assert isinstance(response.json['stock'], dict)
+    else :
+        assert response.json['error'] == 'Invalid timestamp or portion IDs'
+
+def test_inventory_ledger (flask_app, create_admin_user, admin_login, mock_auth) :
+    admin_login
+    admin = create_admin_user
+
+    product = Product(
+        name = 'Ledger Product',
+        description = 'Description',
+        category = Category.PIE,
+    )
+    db.session.add(product)
+    db.session.flush()
+
+    portions = product.create_portions(10.00)
+    db.session.add_all(portions)
+
+    for portion in portions :
+        portion.update_stock(5)
+
+    db.session.commit()
+
+    portion = portions[0]
+
+    # a sale and a restock, each in its own transaction
+    Portion.reserve_stock({ portion.id: 2 })
+    db.session.commit()
+
+    Portion.add_stock([(product.id, portion.id, 4)])
+    db.session.commit()
+
+    # every write appended its movement, and the movements add up to the stock
+    movements = Inventory_Movement.query.filter_by(portion_id = portion.id).order_by(Inventory_Movement.id).all()
+
+    assert [ (movement.kind, movement.quantity) for movement in movements ] == [
+        (Movement_Kind.ADJUSTMENT, 5),
+        (Movement_Kind.SALE, -2),
+        (Movement_Kind.RESTOCK, 4),
+    ]
+    assert db.session.get(Portion, portion.id).stock == 7
+
+    adjusted_at, sold_at, restocked_at = [ movement.created_at for movement in movements ]
+
+    def reconstructed (at, portion_id = portion.id) :
+        return { id: stock for id, product_id, stock in stock_at(at, [portion_id]) }[portion_id]
+
+    # replayed from the ledger alone, no snapshot covers the portion yet
+    assert reconstructed(adjusted_at - timedelta(seconds = 1)) == 0
+    assert reconstructed(adjusted_at) == 5
+    assert reconstructed(sold_at) == 3
+    assert reconstructed(restocked_at) == 7
+
+    written, drifted = snapshot_inventory(lag = timedelta(0))
+
+    assert written >= len(portions)
+    assert portion.id not in drifted
+
+    snapshot = Inventory_Snapshot.query.filter_by(portion_id = portion.id).one()
+    assert snapshot.stock == 7
+
+    Portion.add_stock([(product.id, portion.id, 1)])
+    db.session.commit()
+
+    later = datetime.now(timezone.utc).replace(tzinfo = None) + timedelta(minutes = 1)
+
+    # before the snapshot the ledger is replayed as before, after it the snapshot is the starting point
+    assert reconstructed(sold_at) == 3
+    assert reconstructed(later) == 8
+
+    snapshot.stock = 100
+    db.session.commit()
+
+    assert reconstructed(later) == 101
+
+    # the endpoint reports the same reconstruction, keyed by product then portion
+    with mock_auth(admin.id, 'admin') :
+        response = flask_app.get('/api/product/inventory/stock', query_string = { 'at': later.isoformat(), 'portionIds': str(portion.id) })
+
+    assert response.status_code == 200
+    assert response.json['stock'] == { str(product.id): { str(portion.id): 101 } }
+
+    # stock written without a movement no longer matches the ledger
+    snapshot.stock = 7
+    db.session.execute(update(Portion).where(Portion.id == portion.id).values(stock = 50))
+    db.session.commit()
+
+    written, drifted = snapshot_inventory(lag = timedelta(0))
+    assert portion.id in drifted
+
+    # only the portion that moved since its snapshot got a new one, the others' snapshots still hold their stock
+    assert Inventory_Snapshot.query.filter_by(portion_id = portion.id).count() == 2
+
+    for other_portion in portions[1:] :
+        assert Inventory_Snapshot.query.filter_by(portion_id = other_portion.id).count() == 1
+        assert reconstructed(later, other_portion.id) == 5
+
+
+# ---- helpers ----
+
+def listing_ids_by_page (flask_app, query_params) :
+    # walk every numbered page, served from the catalog's sorted set indexes when not searching
+    ids = []
+    page = 1
+
+    while True :
+        response = flask_app.get('/api/product/', query_string = { **query_params, 'page': page })
+        assert response.status_code == 200
+
+        ids.extend(product['id'] for product in response.json['products'])
+
+        if page >= response.json.get('totalPages', 0) :
+            return ids
+
+        page += 1
+
+def listing_ids_by_cursor (flask_app, query_params) :
+    # walk every keyset page, always ordered by the database
+    ids = []
+    cursor = ''
+
+    while cursor is not None :
+        response = flask_app.get('/api/product/', query_string = { **query_params, 'cursor': cursor })
+        assert response.status_code == 200
+
+        ids.extend(product['id'] for product in response.json['products'])
+        cursor = response.json['nextCursor']
+
+    return ids
+
+def image_file (size, mode, image_format) :
+    # encodes a blank image of the given size, mode and format
+    output = io.BytesIO()
+    Image.new(mode, size).save(output, format = image_format)
+
+    return output.getvalue()